@@ -0,0 +1,141 @@
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict
+
+from .cancellation import DeadlineExceeded, request_deadline, time_left
+from .tasks import detached_context
+
+
+class TTLCache:
+    """LRU cache whose entries also expire `ttl` seconds after insertion.
+
+    Keys are tuples starting with the index name, so entries can be
+    invalidated per index.
+    """
+
+    def __init__(self, maxsize=256, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            del self._data[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, index=None):
+        if index is None:
+            self._data.clear()
+            return
+        for key in [key for key in self._data if key[0] == index]:
+            del self._data[key]
+
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize,
+                "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one awaitable.
+
+    The first caller starts `fn()`; callers arriving while it is still
+    running wait for the same result instead of issuing their own call,
+    each for at most the time left before its own request deadline.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = dict()
+
+    async def do(self, key, fn):
+        future = self._in_flight.get(key)
+        if future is None:
+            # the call is shared, so it does not run under the deadline of
+            # whichever request happened to start it
+            context = contextvars.copy_context()
+            context.run(request_deadline.set, None)
+            future = context.run(asyncio.ensure_future, fn())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._forget(key, future))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+        # shielded so a waiter going away, or running out of time, does not
+        # cancel the call for everybody else
+        left = time_left()
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), left)
+        except asyncio.TimeoutError:
+            if future.done():
+                raise
+            raise DeadlineExceeded("Request deadline exceeded")
+
+    def _forget(self, key, future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+
+    def stats(self):
+        return {"in_flight": len(self._in_flight), "calls": self.calls,
+                "coalesced": self.coalesced}
+
+
+class Snapshot:
+    """Last good result of `fn`, served as is and refreshed in the
+    background; at most one refresh runs at a time.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.value = None
+        self.fetched_at = None
+        self.changed_at = None
+        self._refresh = None
+
+    @property
+    def age(self):
+        if self.fetched_at is None:
+            return None
+        return time.time() - self.fetched_at
+
+    async def refresh(self):
+        if self._refresh is None or self._refresh.done():
+            # shared by every caller waiting for it, so it runs as
+            # background work rather than under the first caller's deadline
+            self._refresh = detached_context().run(asyncio.ensure_future,
+                                                   self._fetch())
+        refresh = self._refresh
+        try:
+            await asyncio.wait_for(asyncio.shield(refresh), time_left())
+        except asyncio.TimeoutError:
+            if refresh.done():
+                raise
+            raise DeadlineExceeded("Request deadline exceeded")
+
+    async def _fetch(self):
+        value = await self.fn()
+        self.fetched_at = time.time()
+        if value != self.value:
+            self.changed_at = self.fetched_at
+        self.value = value
+
+    async def get(self):
+        # only the very first requests wait, for the refresh in progress
+        if self.value is None:
+            await self.refresh()
+        return self.value
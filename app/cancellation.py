@@ -0,0 +1,69 @@
+import asyncio
+import time
+from contextvars import ContextVar
+
+import anyio
+from starlette.responses import StreamingResponse
+
+# monotonic time by which the current request has to be answered; every
+# ES call gets at most the time left
+request_deadline = ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+def time_left():
+    # seconds until the deadline of the request, None without one
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return left
+
+
+async def wait_for_disconnect(request):
+    while True:
+        message = await request.receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def cancel_on_disconnect(request, awaitable):
+    # result of `awaitable`, which is cancelled when the client goes away
+    # before it is done
+    work = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        await asyncio.wait({work, watcher},
+                           return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not work.done():
+            work.cancel()
+            await asyncio.gather(work, return_exceptions=True)
+    if work.cancelled():
+        raise ClientDisconnected()
+    return work.result()
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse closing its body iterator when it stops, also
+    when the client disconnected mid-stream, so the generators behind it
+    stop paging and close their point in time.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if hasattr(self.body_iterator, 'aclose'):
+                with anyio.CancelScope(shield=True):
+                    await self.body_iterator.aclose()
@@ -0,0 +1,25 @@
+import hashlib
+from email.utils import formatdate
+
+
+def make_etag(version, path, query_items):
+    # weak validator of a GET response: the data version it was built from
+    # and the request, with the query parameters in a canonical order
+    request = repr((path, sorted(query_items)))
+    digest = hashlib.sha1(f"{version}|{request}".encode('utf-8')).hexdigest()
+    return f'W/"{digest[:24]}"'
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match uses weak comparison, the W/ prefix is ignored
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque
+               for candidate in if_none_match.split(","))
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
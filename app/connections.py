@@ -0,0 +1,48 @@
+import asyncio
+import logging
+
+from elasticsearch.exceptions import TransportError
+
+logger = logging.getLogger(__name__)
+
+
+def node_connections(es):
+    # one AIOHttpConnection per node; empty until the first request
+    return list(getattr(es.transport.connection_pool, 'connections', []))
+
+
+async def warm_up(es, connections, timeout=5):
+    # opens the client and `connections` keep-alive connections per node,
+    # so the first requests do not pay for TCP and TLS handshakes; gives
+    # up after `timeout` seconds, an unreachable cluster is not waited for
+    async def open_connections():
+        await es.ping(request_timeout=timeout)
+        for connection in node_connections(es):
+            await asyncio.gather(*(connection.perform_request(
+                'HEAD', '/', timeout=timeout) for _ in range(connections)))
+
+    try:
+        await asyncio.wait_for(open_connections(), timeout)
+    except (TransportError, asyncio.TimeoutError) as e:
+        logger.warning("Elasticsearch warm-up failed: %r", e)
+
+
+def pool_stats(es):
+    # connections held by the aiohttp connector of every node; these are
+    # private aiohttp attributes, nodes whose connector lacks them are left
+    # out
+    nodes = dict()
+    for connection in node_connections(es):
+        connector = getattr(getattr(connection, 'session', None),
+                            'connector', None)
+        acquired = getattr(connector, '_acquired', None)
+        idle = getattr(connector, '_conns', None)
+        limit = getattr(connector, 'limit', 0)
+        if acquired is None or idle is None:
+            continue
+        in_use = len(acquired)
+        nodes[connection.host] = {
+            "maxsize": limit, "in_use": in_use,
+            "idle": sum(len(conns) for conns in idle.values()),
+            "utilization": round(in_use / limit, 3) if limit else None}
+    return nodes
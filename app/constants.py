@@ -8,4 +8,28 @@ DATA_PORTAL_AGGREGATIONS = [
 ARTICLES_AGGREGATIONS = ["pubYear", "journalTitle", "articleType"]
 
 PHYLOGENETIC_RANKS = (
-        'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')
\ No newline at end of file
+        'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')
+
+# (CSV header, _source field) pairs for the "metadata" download option
+DATA_PORTAL_CSV_COLUMNS = (
+    ('Organism', 'organism'), ('Common Name', 'commonName'),
+    ('Common Name Source', 'commonNameSource'),
+    ('Current Status', 'currentStatus'))
+
+TRACKING_STATUS_CSV_COLUMNS = (
+    ('Organism', 'organism'), ('Common Name', 'commonName'),
+    ('Metadata submitted to BioSamples', 'biosamples'),
+    ('Raw data submitted to ENA', 'raw_data'),
+    ('Mapped reads submitted to ENA', 'mapped_reads'),
+    ('Assemblies submitted to ENA', 'assemblies_status'),
+    ('Annotation complete', 'annotation_complete'),
+    ('Annotation submitted to ENA', 'annotation_status'))
+
+# fields matched by the `search` parameter of the listing endpoint
+DATA_PORTAL_SEARCH_FIELDS = ["organism", "commonName", "symbionts_records.organism.text"]
+
+ARTICLES_SEARCH_FIELDS = ["title", "journal_name", "study_id", "organism_name"]
+
+# nested fields carried by the export formats that keep whole records
+EXPORT_NESTED_FIELDS = ('records', 'symbionts_records', 'metagenomes_records',
+                        'experiment', 'genome_notes', 'taxonomies')
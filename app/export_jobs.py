@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+import re
+import time
+import uuid
+
+from .tasks import start_periodic
+
+logger = logging.getLogger(__name__)
+
+# names of the files _export writes, finished or not
+SPOOL_FILE = re.compile(r'[0-9a-f]{32}\.[a-z.]+')
+
+
+class ExportJob:
+    def __init__(self, key, run, media_type, extension):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.run = run
+        self.media_type = media_type
+        self.extension = extension
+        self.status = 'queued'
+        self.rows = 0
+        self.total = None
+        self.size = 0
+        self.error = None
+        self.path = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def summary(self):
+        return {"job_id": self.id, "status": self.status, "rows": self.rows,
+                "total": self.total, "size": self.size, "error": self.error,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at}
+
+
+class ExportJobs:
+    """Runs exports on a bounded pool of workers, writing each file to the
+    spool directory. Jobs submitted with the key of a queued, running or
+    finished job are answered with that job instead of a new export.
+
+    Jobs only live in memory: files left in the spool directory by an
+    earlier process are removed on start, and expired files every
+    `evict_interval` seconds.
+    """
+
+    def __init__(self, spool_dir, workers=2, max_files=50, ttl=86400,
+                 evict_interval=600):
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.max_files = max_files
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+        self.jobs = dict()
+        self.jobs_by_key = dict()
+        self._queue = asyncio.Queue()
+        self._tasks = []
+
+    def start(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._sweep()
+        self._tasks = [asyncio.create_task(self._work())
+                       for _ in range(self.workers)]
+
+        async def evict():
+            self._evict()
+
+        self._tasks.append(start_periodic(self.evict_interval, evict,
+                                          "export file eviction"))
+
+    def _sweep(self):
+        # no job of this process refers to them yet
+        for name in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, name)
+            if not SPOOL_FILE.fullmatch(name) or not os.path.isfile(path):
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning("Could not remove %s: %r", path, e)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def submit(self, key, run, media_type, extension):
+        # run(job) returns an async iterator of the bytes of the file
+        job = self.jobs_by_key.get(key)
+        if job is not None and job.status != 'failed' and \
+                time.time() - job.created_at < self.ttl:
+            return job
+        job = ExportJob(key, run, media_type, extension)
+        self.jobs[job.id] = job
+        self.jobs_by_key[key] = job
+        self._queue.put_nowait(job)
+        return job
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._export(job)
+            finally:
+                self._queue.task_done()
+
+    async def _export(self, job):
+        job.status = 'running'
+        path = os.path.join(self.spool_dir, f"{job.id}.{job.extension}")
+        try:
+            with open(f"{path}.part", 'wb') as f:
+                async for chunk in job.run(job):
+                    await asyncio.to_thread(f.write, chunk)
+                    job.size += len(chunk)
+            os.replace(f"{path}.part", path)
+        except (Exception, asyncio.CancelledError) as e:
+            job.status = 'failed'
+            job.error = str(e) or repr(e)
+            if os.path.exists(f"{path}.part"):
+                os.remove(f"{path}.part")
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        else:
+            job.status = 'done'
+            job.path = path
+        finally:
+            job.finished_at = time.time()
+            self._evict()
+
+    def _evict(self):
+        # oldest finished files go first once there are too many, or when
+        # they are past their ttl
+        finished = sorted((job for job in self.jobs.values()
+                           if job.finished_at is not None),
+                          key=lambda job: job.finished_at)
+        expired = len(finished) - self.max_files
+        for position, job in enumerate(finished):
+            if position >= expired and \
+                    time.time() - job.created_at < self.ttl:
+                continue
+            if job.path and os.path.exists(job.path):
+                os.remove(job.path)
+            del self.jobs[job.id]
+            if self.jobs_by_key.get(job.key) is job:
+                del self.jobs_by_key[job.key]
+
+    def stats(self):
+        statuses = dict()
+        for job in self.jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {"workers": self.workers, "queued": self._queue.qsize(),
+                "jobs": statuses}
+
+
+def parse_range(range_header, size):
+    # (start, end) of a single "bytes=" range, None when it can't be served
+    unit, _, byte_range = range_header.partition("=")
+    if unit.strip() != 'bytes' or "," in byte_range:
+        return None
+    start, _, end = byte_range.strip().partition("-")
+    try:
+        if not start:
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+async def read_file(path, start, end, chunk_size=1024 * 1024):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
@@ -0,0 +1,171 @@
+import csv
+import io
+import zlib
+
+import orjson
+
+from .constants import DATA_PORTAL_CSV_COLUMNS, TRACKING_STATUS_CSV_COLUMNS, \
+    EXPORT_NESTED_FIELDS
+
+
+def get_csv_columns(download_option, index_name):
+    if download_option.lower() == "metadata" and index_name in ['data_portal', 'data_portal_test']:
+        return DATA_PORTAL_CSV_COLUMNS
+    elif download_option.lower() == "metadata" and index_name in ['tracking_status', 'tracking_status_index_test']:
+        return TRACKING_STATUS_CSV_COLUMNS
+    return ()
+
+
+async def iterate_batches(first_batch, batches):
+    results = first_batch
+    try:
+        while results is not None:
+            yield results
+            results = await anext(batches, None)
+    finally:
+        await batches.aclose()
+
+
+async def create_data_files_csv(first_batch, batches, columns):
+    # rows are written and flushed one ES page at a time, so memory stays
+    # bounded by the batch size rather than the size of the export
+    output = io.StringIO()
+    csv_writer = csv.writer(output)
+    csv_writer.writerow([header for header, _ in columns])
+
+    pages = iterate_batches(first_batch, batches)
+    try:
+        async for results in pages:
+            if columns:
+                for entry in results:
+                    record = entry["_source"]
+                    csv_writer.writerow(
+                        [record.get(field, '') for _, field in columns])
+            yield output.getvalue().encode('utf-8')
+            output.seek(0)
+            output.truncate(0)
+    finally:
+        await pages.aclose()
+
+
+async def create_data_files_csv_gzip(first_batch, batches, columns):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    chunks = create_data_files_csv(first_batch, batches, columns)
+    try:
+        async for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+    finally:
+        await chunks.aclose()
+    yield compressor.flush()
+
+
+async def create_data_files_ndjson(first_batch, batches, columns):
+    # complete documents, nested records included
+    pages = iterate_batches(first_batch, batches)
+    try:
+        async for results in pages:
+            yield b''.join(orjson.dumps(entry["_source"]) + b'\n'
+                           for entry in results)
+    finally:
+        await pages.aclose()
+
+
+class ChunkSink(io.RawIOBase):
+    # file object handed to the parquet writer, collecting what it writes
+    # until the next chunk is taken
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_value(value):
+    if value is None or isinstance(value, str):
+        return value
+    return orjson.dumps(value).decode('utf-8')
+
+
+async def create_data_files_parquet(first_batch, batches, columns):
+    # one row group per ES page; nested records are stored as JSON strings
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    fields = [field for _, field in columns] + list(EXPORT_NESTED_FIELDS)
+    schema = pa.schema([(field, pa.string()) for field in fields])
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    pages = iterate_batches(first_batch, batches)
+    try:
+        async for results in pages:
+            table = pa.Table.from_pydict(
+                {field: [parquet_value(entry["_source"].get(field))
+                         for entry in results] for field in fields},
+                schema=schema)
+            writer.write_table(table)
+            yield sink.take()
+    finally:
+        # also when the stream is closed early
+        await pages.aclose()
+        writer.close()
+    yield sink.take()
+
+
+# format name: (media type, file extension, writer, full documents needed)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv', create_data_files_csv, False),
+    'csv.gz': ('application/gzip', 'csv.gz', create_data_files_csv_gzip, False),
+    'ndjson': ('application/x-ndjson', 'ndjson', create_data_files_ndjson, True),
+    'parquet': ('application/vnd.apache.parquet', 'parquet',
+                create_data_files_parquet, False),
+}
+
+EXPORT_MEDIA_TYPES = {
+    'text/csv': 'csv',
+    'application/gzip': 'csv.gz',
+    'application/x-gzip': 'csv.gz',
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+    'application/vnd.apache.parquet': 'parquet',
+    'application/x-parquet': 'parquet',
+}
+
+
+def resolve_export_format(requested, accept):
+    # an explicit format wins over the Accept header, CSV is the default
+    if requested:
+        return requested.lower() if requested.lower() in EXPORT_FORMATS \
+            else None
+    for media_type in (accept or '').split(","):
+        export_format = EXPORT_MEDIA_TYPES.get(media_type.split(";")[0].strip())
+        if export_format:
+            return export_format
+    return 'csv'
+
+
+def export_source_fields(export_format, columns):
+    # _source fields an export needs, None for complete documents and
+    # False when it writes no fields at all
+    if EXPORT_FORMATS[export_format][3]:
+        return None
+    fields = [field for _, field in columns]
+    if export_format == 'parquet':
+        fields.extend(EXPORT_NESTED_FIELDS)
+    return fields or False
@@ -0,0 +1,60 @@
+import logging
+import time
+
+from elasticsearch.exceptions import TransportError
+
+logger = logging.getLogger(__name__)
+
+
+class IndexGenerations:
+    """Cheap marker that changes whenever documents of an index are added,
+    updated or deleted, read from the primaries' index stats.
+
+    `poll` refreshes the generations of `indexes`, which are the only
+    ones to be read; `on_change` is called with the index name whenever a
+    generation moves on.
+    """
+
+    def __init__(self, ttl=30, indexes=(), on_change=None):
+        self.ttl = ttl
+        self.on_change = on_change
+        self.indexes = set(indexes)
+        self._generations = dict()
+        self._changed_at = dict()
+
+    async def fetch(self, es, index):
+        stats = await es.indices.stats(index=index, metric='docs,indexing')
+        primaries = stats['_all']['primaries']
+        generation = "-".join(str(value) for value in (
+            primaries['docs']['count'], primaries['docs']['deleted'],
+            primaries['indexing']['index_total'],
+            primaries['indexing']['delete_total']))
+        previous = self._generations.get(index)
+        self._generations[index] = (time.monotonic() + self.ttl, generation)
+        if previous is None or previous[1] != generation:
+            self._changed_at[index] = time.time()
+            if previous is not None and self.on_change is not None:
+                self.on_change(index)
+        return generation
+
+    async def get(self, es, index):
+        entry = self._generations.get(index)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return await self.fetch(es, index)
+
+    def changed_at(self, index):
+        # when the current generation was first seen
+        return self._changed_at.get(index)
+
+    async def poll(self, es):
+        for index in list(self.indexes):
+            try:
+                await self.fetch(es, index)
+            except TransportError as e:
+                logger.warning("generation of %s failed: %r", index, e)
+
+    def stats(self):
+        return {index: {"generation": generation,
+                        "changed_at": self._changed_at.get(index)}
+                for index, (_, generation) in self._generations.items()}
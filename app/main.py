@@ -1,18 +1,50 @@
-import csv
+import asyncio
+import logging
 import os
 import re
+import tempfile
+import time
 from elasticsearch import AsyncElasticsearch, AIOHttpConnection
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-import io
 
 from pydantic import BaseModel
-from fastapi.responses import StreamingResponse, JSONResponse
-from elasticsearch.exceptions import ConnectionTimeout
-from .constants import DATA_PORTAL_AGGREGATIONS, ARTICLES_AGGREGATIONS, PHYLOGENETIC_RANKS
-
-
-app = FastAPI()
+from fastapi.responses import JSONResponse, ORJSONResponse, \
+    PlainTextResponse, Response
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Match
+from elasticsearch.exceptions import ConnectionTimeout, NotFoundError, \
+    TransportError
+from .constants import PHYLOGENETIC_RANKS
+from .export_jobs import ExportJobs, parse_range, read_file
+from .exporters import EXPORT_FORMATS, get_csv_columns, \
+    resolve_export_format, export_source_fields
+from .pagination import CursorExpired, iterate_sliced_pages, parse_sort, \
+    encode_cursor, decode_cursor, close_pit
+from .cache import TTLCache, SingleFlight, Snapshot
+from .conditional import make_etag, etag_matches, http_date
+from .generation import IndexGenerations
+from .search_index import SearchIndexes
+from .taxonomy import TaxonomyIndex
+from .tasks import start_periodic, start_background, stop_background_tasks
+from .scheduler import Admission, Pool, PoolBusy, Scheduler, admission, \
+    traffic_class
+from .profiling import Profile, current_profile, profile_phase
+from .metrics import MetricsMiddleware, Gauge, export_rows, index_label, \
+    known_indexes, register, render_metrics
+from .connections import warm_up, pool_stats
+from .cancellation import request_deadline, DeadlineExceeded, \
+    ClientDisconnected, ClosingStreamingResponse, cancel_on_disconnect
+from .transport import ScheduledTransport
+from .query import build_query, build_aggregations, build_details_query, \
+    query_spec, normalize_fields, source_filter
+
+logger = logging.getLogger(__name__)
+
+
+# endpoints returning ES hits build their ORJSONResponse themselves, which
+# skips FastAPI's jsonable_encoder pass over every _source document
+app = FastAPI(default_response_class=ORJSONResponse)
 
 origins = [
     "*"
@@ -31,16 +63,392 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+def env_flag(name, default=False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes')
+
+
+# connection pool and transport behaviour of the ES client
+ES_TIMEOUT = float(os.getenv('ES_TIMEOUT', 120))
+ES_MAXSIZE = int(os.getenv('ES_MAXSIZE', 25))
+ES_WARMUP_CONNECTIONS = int(os.getenv('ES_WARMUP_CONNECTIONS', 4))
+ES_WARMUP_TIMEOUT = float(os.getenv('ES_WARMUP_TIMEOUT', 5))
+sniffer_timeout = os.getenv('ES_SNIFFER_TIMEOUT')
+
 es = AsyncElasticsearch(
     [ES_HOST],
-    timeout=120,
+    timeout=ES_TIMEOUT,
     connection_class=AIOHttpConnection,
+    transport_class=ScheduledTransport,
+    maxsize=ES_MAXSIZE,
+    http_compress=env_flag('ES_HTTP_COMPRESS', True),
+    max_retries=int(os.getenv('ES_MAX_RETRIES', 3)),
+    retry_on_timeout=env_flag('ES_RETRY_ON_TIMEOUT'),
+    sniff_on_start=env_flag('ES_SNIFF_ON_START'),
+    sniff_on_connection_fail=env_flag('ES_SNIFF_ON_CONNECTION_FAIL'),
+    sniffer_timeout=float(sniffer_timeout) if sniffer_timeout else None,
     http_auth=(ES_USERNAME, ES_PASSWORD),
     use_ssl=True, verify_certs=True)
+# interactive calls give up long before exports do
+es.transport.timeouts = {
+    'interactive': float(os.getenv('ES_INTERACTIVE_TIMEOUT', 30)),
+    'detail': float(os.getenv('ES_DETAIL_TIMEOUT', 30)),
+    'bulk': float(os.getenv('ES_BULK_TIMEOUT', ES_TIMEOUT)),
+    'background': float(os.getenv('ES_BACKGROUND_TIMEOUT', ES_TIMEOUT)),
+}
+register(Gauge(
+    'es_pool_connections', 'Connections to each ES node by state',
+    ('host', 'state'),
+    lambda: {(host, state): node[state] for host, node in pool_stats(es).items()
+             for state in ('in_use', 'idle', 'maxsize')}))
+
+# every ES call waits for a slot of its traffic class; interactive listings
+# go first, exports can't take more than their share of the cluster
+scheduler = Scheduler([
+    Pool('interactive', 0,
+         int(os.getenv('INTERACTIVE_CONCURRENCY', 16)),
+         max_queue=int(os.getenv('INTERACTIVE_MAX_QUEUE', 64)),
+         max_wait=float(os.getenv('INTERACTIVE_MAX_WAIT', 5))),
+    Pool('detail', 1,
+         int(os.getenv('DETAIL_CONCURRENCY', 8)),
+         max_queue=int(os.getenv('DETAIL_MAX_QUEUE', 64)),
+         max_wait=float(os.getenv('DETAIL_MAX_WAIT', 5))),
+    Pool('bulk', 2,
+         int(os.getenv('BULK_CONCURRENCY', 4)),
+         max_queue=int(os.getenv('BULK_MAX_QUEUE', 16)),
+         max_wait=float(os.getenv('BULK_MAX_WAIT', 30))),
+    Pool('background', 3,
+         int(os.getenv('BACKGROUND_CONCURRENCY', 2))),
+], max_concurrency=int(os.getenv('ES_MAX_CONCURRENCY', 20)))
+es.transport.scheduler = scheduler
+
+# PIT slices fetched concurrently by exports and the downloader endpoint
+EXPORT_SLICES = int(os.getenv('EXPORT_SLICES', 1))
+EXPORT_MAX_SLICES = int(os.getenv('EXPORT_MAX_SLICES', 8))
+EXPORT_SLICE_CONCURRENCY = int(os.getenv('EXPORT_SLICE_CONCURRENCY', 4))
+
+# exports run in the background and kept on disk for reuse
+export_jobs = ExportJobs(
+    os.getenv('EXPORT_SPOOL_DIR',
+              os.path.join(tempfile.gettempdir(), 'erga-exports')),
+    workers=int(os.getenv('EXPORT_WORKERS', 2)),
+    max_files=int(os.getenv('EXPORT_MAX_FILES', 50)),
+    ttl=int(os.getenv('EXPORT_FILE_TTL', 86400)),
+    evict_interval=int(os.getenv('EXPORT_EVICT_INTERVAL', 600)))
+# requests sent with an X-Profile header or a `profile` parameter ('1',
+# or 'es' for the ES profile API output too) get a Server-Timing header
+PROFILING_ENABLED = env_flag('PROFILING_ENABLED')
+
+# how long the point in time of a listing cursor stays open between pages;
+# after the first page only for CURSOR_FIRST_KEEP_ALIVE, so walks that are
+# not read past it don't hold theirs for long
+CURSOR_KEEP_ALIVE = os.getenv('CURSOR_KEEP_ALIVE', '5m')
+CURSOR_FIRST_KEEP_ALIVE = os.getenv('CURSOR_FIRST_KEEP_ALIVE', '1m')
+
+# species per terms query and how many of those queries run at once
+SPECIES_CHUNK_SIZE = 500
+SPECIES_CHUNK_CONCURRENCY = 4
+
+facet_cache = TTLCache(maxsize=int(os.getenv('FACET_CACHE_SIZE', 512)),
+                       ttl=int(os.getenv('FACET_CACHE_TTL', 300)))
+details_cache = TTLCache(maxsize=int(os.getenv('DETAILS_CACHE_SIZE', 2048)),
+                         ttl=int(os.getenv('DETAILS_CACHE_TTL', 3600)))
+# identical searches running at the same time share one ES call
+single_flight = SingleFlight()
+
+# indexes served under /{index}; only these have their generation polled
+# and appear as metric labels
+ES_INDEXES = [name for name in os.getenv(
+    'ES_INDEXES', 'data_portal,tracking_status,articles,summary').split(',')
+    if name]
+
+# in-process substring index answering `search` without leading wildcards
+search_indexes = SearchIndexes(
+    [name for name in os.getenv(
+        'SEARCH_INDEX_NAMES', 'data_portal,tracking_status').split(',')
+     if name],
+    max_ids=int(os.getenv('SEARCH_INDEX_MAX_IDS', 10000)))
+SEARCH_INDEX_REFRESH_INTERVAL = int(os.getenv('SEARCH_INDEX_REFRESH_INTERVAL', 900))
+
+# in-memory taxonomy tree of the data portal documents
+taxonomy_index = TaxonomyIndex(os.getenv('TAXONOMY_INDEX', 'data_portal'))
+TAXONOMY_REFRESH_INTERVAL = int(os.getenv('TAXONOMY_REFRESH_INTERVAL', 900))
+
+# /summary is served from the last good response of the summary index
+summary_snapshot = Snapshot(lambda: fetch_summary())
+SUMMARY_REFRESH_INTERVAL = int(os.getenv('SUMMARY_REFRESH_INTERVAL', 60))
+
+# generations are polled so conditional GETs are answered without ES; a
+# new generation drops the cached results of the index and rebuilds the
+# in-process indexes made from it
+index_generations = IndexGenerations(
+    indexes=(*ES_INDEXES, taxonomy_index.index_name,
+             *search_indexes.index_names),
+    on_change=lambda index: generation_changed(index))
+known_indexes.update(index_generations.indexes)
+GENERATION_POLL_INTERVAL = int(os.getenv('GENERATION_POLL_INTERVAL', 10))
+HTTP_CACHE_MAX_AGE = int(os.getenv('HTTP_CACHE_MAX_AGE', 60))
+# least seconds between two rebuilds of the same in-process index
+INDEX_REBUILD_INTERVAL = int(os.getenv('INDEX_REBUILD_INTERVAL', 60))
+index_rebuilds = dict()
+pending_rebuilds = set()
+
+
+def rebuild_in_background(name, fn):
+    # one rebuild of each kind at a time; changes arriving while it runs
+    # get one more rebuild once INDEX_REBUILD_INTERVAL has passed
+    task = index_rebuilds.get(name)
+    if task is not None and not task.done():
+        pending_rebuilds.add(name)
+        return
+
+    async def rebuild():
+        while True:
+            pending_rebuilds.discard(name)
+            await fn()
+            if name not in pending_rebuilds:
+                return
+            await asyncio.sleep(INDEX_REBUILD_INTERVAL)
+
+    index_rebuilds[name] = start_background(rebuild, name)
+
+
+def generation_changed(index):
+    facet_cache.invalidate(index)
+    details_cache.invalidate(index)
+    if index == 'summary':
+        start_background(summary_snapshot.refresh, "summary refresh")
+    if index in search_indexes.index_names:
+        search_indexes.mark_changed(index)
+        rebuild_in_background(f"search index rebuild of {index}",
+                              lambda: search_indexes.build(es, index))
+    if index == taxonomy_index.index_name:
+        rebuild_in_background("taxonomy rebuild",
+                              lambda: taxonomy_index.refresh(es))
+
+
+def matched_route(scope):
+    for route in app.router.routes:
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL:
+            return route, child_scope
+    return None, None
+
+
+def route_template(scope):
+    # the path of the route serving a request, e.g. /{index}/{record_id}
+    route, _ = matched_route(scope)
+    return route.path if route is not None else 'unmatched'
+
+
+async def cache_validator(request):
+    # (version, last modified) of the data a GET answers from, None when
+    # the response is not cacheable
+    if request.method != 'GET' or current_profile.get() is not None:
+        return None
+    route, child_scope = matched_route(request.scope)
+    if route is None:
+        return None
+    endpoint = child_scope['endpoint']
+    if endpoint is summary:
+        changed_at = summary_snapshot.changed_at
+        return (changed_at, changed_at) if changed_at else None
+    if endpoint is root or endpoint is details:
+        index = child_scope['path_params']['index']
+        if index not in index_generations.indexes:
+            # favicon.ico, patterns such as * and mistyped names
+            return None
+        try:
+            generation = await index_generations.get(es, index)
+        except (TransportError, PoolBusy, DeadlineExceeded):
+            # this runs outside the exception handlers; the request itself
+            # is answered without a validator
+            return None
+        return generation, index_generations.changed_at(index)
+    return None
+
+
+class HTTPMiddleware:
+    """Runs `handler(app, scope, receive, send)` for every HTTP request.
+
+    Used instead of @app.middleware("http"): starlette's
+    BaseHTTPMiddleware swallows errors raised once a streamed response has
+    started, so a download failing half way would end as if it were
+    complete rather than being aborted.
+    """
+
+    def __init__(self, app, handler):
+        self.app = app
+        self.handler = handler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        await self.handler(self.app, scope, receive, send)
+
+
+async def conditional_get(app, scope, receive, send):
+    request = Request(scope)
+    validator = await cache_validator(request)
+    if validator is None:
+        return await app(scope, receive, send)
+    version, changed_at = validator
+    etag = make_etag(version, request.url.path,
+                     request.query_params.multi_items())
+    headers = {"ETag": etag,
+               "Cache-Control": f"public, max-age={HTTP_CACHE_MAX_AGE}"}
+    if changed_at:
+        headers["Last-Modified"] = http_date(changed_at)
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        response = Response(status_code=304, headers=headers)
+        return await response(scope, receive, send)
+
+    async def send_validated(message):
+        if message['type'] == 'http.response.start' and \
+                message['status'] == 200:
+            MutableHeaders(scope=message).update(headers)
+        await send(message)
+
+    await app(scope, receive, send_validated)
+
+
+app.add_middleware(HTTPMiddleware, handler=conditional_get)
+
+
+BULK_PATHS = ('/data-download', '/downloader_utility_data', '/export-jobs')
+
+
+def request_traffic_class(request):
+    path = request.url.path
+    if path.startswith(BULK_PATHS):
+        return 'bulk'
+    segments = [segment for segment in path.split("/") if segment]
+    if len(segments) == 2 and (request.method == 'GET'
+                               or segments[1] == 'details'):
+        return 'detail'
+    return 'interactive'
+
+
+# seconds a request of each traffic class has for all its ES calls; an
+# X-Request-Timeout header can only shorten it
+REQUEST_DEADLINES = {
+    'interactive': float(os.getenv('INTERACTIVE_DEADLINE', 30)),
+    'detail': float(os.getenv('DETAIL_DEADLINE', 30)),
+    'bulk': float(os.getenv('BULK_DEADLINE', 900)),
+}
+
+
+async def classify_traffic(app, scope, receive, send):
+    request = Request(scope)
+    name = request_traffic_class(request)
+    budget = REQUEST_DEADLINES.get(name)
+    try:
+        requested = float(request.headers.get('x-request-timeout', 'nan'))
+    except ValueError:
+        requested = float('nan')
+    if requested > 0:
+        budget = min(budget, requested) if budget else requested
+    class_token = traffic_class.set(name)
+    deadline_token = request_deadline.set(
+        time.monotonic() + budget if budget else None)
+    try:
+        await app(scope, receive, send)
+    finally:
+        request_deadline.reset(deadline_token)
+        traffic_class.reset(class_token)
+
+
+app.add_middleware(HTTPMiddleware, handler=classify_traffic)
+
+
+async def profile_request(app, scope, receive, send):
+    request = Request(scope)
+    level = request.headers.get('x-profile') or \
+        request.query_params.get('profile')
+    if not PROFILING_ENABLED or not level:
+        return await app(scope, receive, send)
+    profile = Profile(es_profile=level == 'es')
+
+    async def send_timed(message):
+        if message['type'] == 'http.response.start':
+            MutableHeaders(scope=message)['Server-Timing'] = \
+                profile.server_timing()
+        await send(message)
+
+    token = current_profile.set(profile)
+    try:
+        await app(scope, receive, send_timed)
+    finally:
+        current_profile.reset(token)
+
+
+app.add_middleware(HTTPMiddleware, handler=profile_request)
+
+
+def json_response(data):
+    # ORJSONResponse, timed and carrying the ES profile output when the
+    # request is profiled
+    profile = current_profile.get()
+    if profile is None:
+        return ORJSONResponse(data)
+    if profile.es_profile and isinstance(data, dict):
+        data = dict(data, profile=profile.es_profiles)
+    with profile.phase('serialize'):
+        return ORJSONResponse(data)
+
+
+# added last so it wraps every other middleware
+app.add_middleware(MetricsMiddleware, route_of=route_template)
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded(request: Request, exc: DeadlineExceeded):
+    return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected(request: Request, exc: ClientDisconnected):
+    # nobody reads this; 499 keeps abandoned requests apart in the metrics
+    return Response(status_code=499)
+
+
+@app.exception_handler(PoolBusy)
+async def pool_busy(request: Request, exc: PoolBusy):
+    return JSONResponse(status_code=exc.status_code,
+                        content={"detail": str(exc)},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+
+@app.on_event("startup")
+async def start_background_refresh():
+    # serving does not wait for the cluster, as it didn't before warm-up
+    start_background(
+        lambda: warm_up(es, ES_WARMUP_CONNECTIONS, ES_WARMUP_TIMEOUT),
+        "Elasticsearch warm-up")
+    start_periodic(SEARCH_INDEX_REFRESH_INTERVAL,
+                   lambda: search_indexes.refresh(es), "search index refresh")
+    start_periodic(TAXONOMY_REFRESH_INTERVAL,
+                   lambda: taxonomy_index.refresh(es), "taxonomy refresh")
+    start_periodic(SUMMARY_REFRESH_INTERVAL, summary_snapshot.refresh,
+                   "summary refresh")
+    start_periodic(GENERATION_POLL_INTERVAL,
+                   lambda: index_generations.poll(es), "generation poll")
+    export_jobs.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_refresh():
+    await export_jobs.stop()
+    await stop_background_tasks()
+    await es.close()
 
 
 @app.get("/downloader_utility_data/")
-async def downloader_utility_data(taxonomy_filter: str, data_status: str, experiment_type: str, project_name: str):
+async def downloader_utility_data(taxonomy_filter: str, data_status: str, experiment_type: str, project_name: str,
+                                  request: Request, fields: str | None = None):
     body = dict()
     if taxonomy_filter != '':
 
@@ -51,8 +459,11 @@ async def downloader_utility_data(taxonomy_filter: str, data_status: str, experi
                 }
             }
 
+            # the taxonomy tree knows which rank the name belongs to, all
+            # ranks are tried only for names it has not seen
+            ranks = taxonomy_index.ranks_of(taxonomy_filter) or PHYLOGENETIC_RANKS
             nested_queries = []
-            for rank in PHYLOGENETIC_RANKS:
+            for rank in ranks:
                 nested_query = {
                     "nested": {
                         "path": f"taxonomies.{rank}",
@@ -75,7 +486,7 @@ async def downloader_utility_data(taxonomy_filter: str, data_status: str, experi
                     "should": nested_queries,
                     "minimum_should_match": 1  # Adjust depending on your logic
                 }
-            }
+            } if len(nested_queries) > 1 else nested_queries[0]
 
 
             body["query"]["bool"]["filter"].append(final_query)
@@ -138,26 +549,48 @@ async def downloader_utility_data(taxonomy_filter: str, data_status: str, experi
     if project_name is not None and project_name != '':
         body["query"]["bool"]["filter"].append(
             {"term": {'project_name': project_name}})
+    projection = source_filter(normalize_fields(fields))
+    if projection:
+        body["_source"] = projection
+
+    async def collect():
+        result = []
+        pages = iterate_sliced_pages(
+            es, "data_portal", body, page_size=10000, slices=EXPORT_SLICES,
+            concurrency=EXPORT_SLICE_CONCURRENCY)
+        try:
+            async for hits in pages:
+                result.extend(hits)
+                export_rows.inc("data_portal", "json", amount=len(hits))
+        finally:
+            await pages.aclose()
+        return result
 
-    response = await es.search(index="data_portal", from_=0, size=10000, body=body)
-    total_count = response['hits']['total']['value']
-    result = response['hits']['hits']
-    results_count = len(response['hits']['hits'])
-    while total_count > results_count:
-        response1 = await es.search(index="data_portal", from_=results_count, size=10000, body=body)
-        result.extend(response1['hits']['hits'])
-        results_count += len(response1['hits']['hits'])
-
-    return result
+    # paging stops, and the PIT is closed, as soon as the client goes away
+    return json_response(await cancel_on_disconnect(request, collect()))
 
 
 @app.get("/downloader_utility_data_with_species/")
-async def downloader_utility_data_with_species(species_list: str, project_name: str):
-    body = dict()
+async def downloader_utility_data_with_species(species_list: str, project_name: str,
+                                               request: Request,
+                                               fields: str | None = None):
     result = []
+    projection = source_filter(normalize_fields(fields))
+    if projection:
+        # organism is needed to put the hits back in species_list order
+        if projection["includes"]:
+            projection["includes"].append("organism")
+        projection["excludes"] = [field for field in projection["excludes"]
+                                  if field != "organism"]
     if species_list != '' and species_list is not None:
-        species_list_array = species_list.split(",")
-        for organism in species_list_array:
+        species_list_array = list(dict.fromkeys(
+            organism.strip() for organism in species_list.split(",")
+            if organism.strip()))
+        chunks = [species_list_array[i:i + SPECIES_CHUNK_SIZE]
+                  for i in range(0, len(species_list_array), SPECIES_CHUNK_SIZE)]
+        semaphore = asyncio.Semaphore(SPECIES_CHUNK_CONCURRENCY)
+
+        async def lookup(chunk):
             body = {
                 "query": {
                     "bool": {
@@ -165,28 +598,120 @@ async def downloader_utility_data_with_species(species_list: str, project_name:
                             {"term": {"project_name": project_name}}
                         ],
                         "should": [
-                            {"term": {"_id": organism}},
-                            {"term": {"organism": organism}}
+                            {"terms": {"_id": chunk}},
+                            {"terms": {"organism": chunk}}
                         ],
                         "minimum_should_match": 1
                     }
                 }
             }
-            response = await es.search(index='data_portal',
-                                       body=body)
-            result.extend(response['hits']['hits'])
+            if projection:
+                body["_source"] = projection
+            async with semaphore:
+                response = await es.search(index='data_portal', body=body,
+                                           size=10000)
+            return response['hits']['hits']
+
+        hits_by_id = dict()
+        hits_by_organism = dict()
+        lookups = asyncio.gather(*(lookup(chunk) for chunk in chunks))
+        for hits in await cancel_on_disconnect(request, lookups):
+            for hit in hits:
+                hits_by_id[hit['_id']] = hit
+                hits_by_organism.setdefault(
+                    hit['_source'].get('organism'), []).append(hit)
+
+        # keep the order of species_list and return every record only once
+        seen = set()
+        for organism in species_list_array:
+            matches = hits_by_organism.get(organism, [])
+            if organism in hits_by_id:
+                matches = [hits_by_id[organism]] + matches
+            for hit in matches:
+                if hit['_id'] not in seen:
+                    seen.add(hit['_id'])
+                    result.append(hit)
+
+    return json_response(result)
 
-    return result
+
+async def fetch_summary():
+    response = await es.search(index="summary")
+    return response['hits']['hits']
 
 
 @app.get("/summary")
 async def summary():
-    response = await es.search(index="summary")
+    results = await summary_snapshot.get()
     data = dict()
-    data['results'] = response['hits']['hits']
+    data['results'] = results
+    data['snapshot_age'] = round(summary_snapshot.age, 3)
+    return data
+
+
+@app.get("/autocomplete")
+async def autocomplete(q: str, index: str = 'data_portal', limit: int = 10):
+    search_index = search_indexes.indexes.get(index)
+    if search_index is None:
+        return {"results": []}
+    return {"results": search_index.autocomplete(q, limit)}
+
+
+@app.get("/taxonomy/tree")
+async def taxonomy_tree(name: str | None = None, rank: str | None = None):
+    tree = taxonomy_index.tree
+    if tree is None:
+        return JSONResponse(status_code=503,
+                            content={"error": "Taxonomy is not loaded yet"})
+    if not name:
+        return {"documents": tree.documents,
+                "children": [node.summary() for node in tree.roots.values()]}
+
+    node = tree.find(name, rank)
+    if node is None:
+        return JSONResponse(status_code=404,
+                            content={"error": f"{name} not found"})
+    data = node.summary()
+    data['parent'] = node.parent.summary() if node.parent else None
+    data['children'] = [child.summary() for child in node.children.values()]
     return data
 
 
+@app.get("/taxonomy/stats")
+async def taxonomy_stats():
+    return taxonomy_index.stats()
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"facets": facet_cache.stats(),
+            "details": details_cache.stats(),
+            "export_jobs": export_jobs.stats(),
+            "single_flight": single_flight.stats(),
+            "search_index": search_indexes.stats(),
+            "generations": index_generations.stats()}
+
+
+@app.get("/scheduler/stats")
+async def scheduler_stats():
+    return dict(scheduler.stats(), connections=pool_stats(es))
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(),
+                             media_type="text/plain; version=0.0.4")
+
+
+@app.post("/cache/invalidate")
+async def invalidate_cache(index: str | None = None):
+    # called after an index has been refreshed; without an index every
+    # cached entry is dropped
+    facet_cache.invalidate(index)
+    details_cache.invalidate(index)
+    return {"facets": facet_cache.stats(), "details": details_cache.stats()}
+
+
 def convert_to_title_case(input_string):
     # Add a space before each capital letter
     spaced_string = re.sub(r'([A-Z])', r' \1', input_string)
@@ -208,394 +733,530 @@ class QueryParam(BaseModel):
     phylogeny_filters: str
     index_name: str
     downloadOption: str
+    slices: int | None = None
+    format: str | None = None
 
 
 @app.post("/data-download")
-async def get_data_files(item: QueryParam):
+async def get_data_files(item: QueryParam, request: Request):
+    export_format = resolve_export_format(item.format,
+                                          request.headers.get('accept'))
+    if export_format is None:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"Unsupported download format {item.format}"}
+        )
+    media_type, extension, writer, _ = EXPORT_FORMATS[export_format]
 
-    data = await fetch_data_in_batches(item)
+    batches = fetch_data_in_batches(item, export_format)
+    first_batch = await anext(batches, None)
 
-    if len(data) > 0 :
-        csv_data = create_data_files_csv(data, item.downloadOption,
-                                         item.index_name)
+    if first_batch:
+        columns = get_csv_columns(item.downloadOption, item.index_name)
+        data = writer(first_batch, batches, columns)
 
-        return StreamingResponse(
-            csv_data,
-            media_type='text/csv',
-            headers={"Content-Disposition": "attachment; filename=download.csv"}
+        return ClosingStreamingResponse(
+            data,
+            media_type=media_type,
+            headers={"Content-Disposition": f"attachment; filename=download.{extension}"}
         )
     else:
+        await batches.aclose()
         return JSONResponse(
             status_code=500,
             content={"error": "There was an issue downloading the file"}
         )
 
 
-def create_data_files_csv(results, download_option, index_name):
-    header = []
-    if download_option.lower() == "metadata" and index_name in ['data_portal', 'data_portal_test']:
-        header = ['Organism', 'Common Name', 'Common Name Source',
-                  'Current Status']
-    elif download_option.lower() == "metadata" and index_name in ['tracking_status', 'tracking_status_index_test']:
-        header = ['Organism', 'Common Name', 'Metadata submitted to BioSamples',
-                  'Raw data submitted to ENA',
-                  'Mapped reads submitted to ENA',
-                  'Assemblies submitted to ENA',
-                  'Annotation complete', 'Annotation submitted to ENA']
-
-    output = io.StringIO()
-    csv_writer = csv.writer(output)
-    csv_writer.writerow(header)
-    for entry in results:
-        record = entry["_source"]
-        if download_option.lower() == "metadata" and index_name in ['data_portal', 'data_portal_test']:
-            organism = record.get('organism', '')
-            common_name = record.get('commonName', '')
-            common_name_source = record.get('commonNameSource', '')
-            current_status = record.get('currentStatus', '')
-            entry = [organism, common_name, common_name_source, current_status]
-            csv_writer.writerow(entry)
-
-        elif download_option.lower() == "metadata" and index_name in ['tracking_status', 'tracking_status_index_test']:
-            organism = record.get('organism', '')
-            common_name = record.get('commonName', '')
-            metadata_biosamples = record.get('biosamples', '')
-            raw_data_ena = record.get('raw_data', '')
-            mapped_reads_ena = record.get('mapped_reads', '')
-            assemblies_ena = record.get('assemblies_status', '')
-            annotation_complete = record.get('annotation_complete', '')
-            annotation_submitted_ena = record.get('annotation_status', '')
-            entry = [organism, common_name, metadata_biosamples, raw_data_ena,
-                     mapped_reads_ena, assemblies_ena,
-                     annotation_complete, annotation_submitted_ena]
-            csv_writer.writerow(entry)
-
-    output.seek(0)
-    return io.BytesIO(output.getvalue().encode('utf-8'))
+async def export_job_chunks(job, item, export_format):
+    spec = query_spec(item.index_name, item.filterValue, item.searchValue,
+                      item.currentClass, item.phylogeny_filters)
+    job.total = await fetch_count(spec)
 
+    def on_progress(rows):
+        job.rows = rows
 
-@app.get("/{index}")
-async def root(index: str, offset: int = 0, limit: int = 15,
-               sort: str | None = None, filter: str | None = None,
-               search: str | None = None, current_class: str = 'kingdom',
-               phylogeny_filters: str | None = None, action: str = None):
-    if index == 'favicon.ico':
-        return None
+    batches = fetch_data_in_batches(item, export_format, on_progress)
+    first_batch = await anext(batches, None)
+    if not first_batch:
+        await batches.aclose()
+        raise ValueError("There was an issue downloading the file")
+    columns = get_csv_columns(item.downloadOption, item.index_name)
+    writer = EXPORT_FORMATS[export_format][2]
+    async for chunk in writer(first_batch, batches, columns):
+        yield chunk
 
-    # data structure for ES query
-    body = dict()
-    # building aggregations for every request
-    body["aggs"] = dict()
-    if 'articles' in index:
-        aggregations_list = ARTICLES_AGGREGATIONS
-    else:
-        aggregations_list = DATA_PORTAL_AGGREGATIONS
 
-    for aggregation_field in aggregations_list:
-        body["aggs"][aggregation_field] = {
-            "terms": {"field": aggregation_field, "size": 20}
-        }
-        if 'data_portal' in index:
-            body["aggs"]["experiment"] = {
-                "nested": {"path": "experiment"},
-                "aggs": {
-                    "library_construction_protocol": {
-                        "terms": {
-                            "field": "experiment.library_construction_protocol.keyword",
-                            "size": 20
-                        },
-                        "aggs": {
-                            "distinct_docs": {
-                                "reverse_nested": {},
-                                # get to the parent document level to count number of docs instead of
-                                # number of terms
-                                "aggs": {
-                                    "parent_doc_count": {
-                                        "cardinality": {
-                                            "field": "tax_id"
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
-            }
+@app.post("/export-jobs", status_code=202)
+async def submit_export_job(item: QueryParam, request: Request):
+    export_format = resolve_export_format(item.format,
+                                          request.headers.get('accept'))
+    if export_format is None:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"Unsupported download format {item.format}"}
+        )
+    media_type, extension, _, _ = EXPORT_FORMATS[export_format]
+
+    # the same query on an unchanged index reuses the file already exported
+    spec = query_spec(item.index_name, item.filterValue, item.searchValue,
+                      item.currentClass, item.phylogeny_filters,
+                      item.sortValue)
+    # without index stats cached files are only reused within their ttl
+    generation = None
+    if item.index_name in index_generations.indexes:
+        try:
+            generation = await index_generations.get(es, item.index_name)
+        except TransportError:
+            pass
+    key = (spec, item.downloadOption.lower(), export_format, generation)
+    job = export_jobs.submit(
+        key, lambda job: export_job_chunks(job, item, export_format),
+        media_type, extension)
+    return job.summary()
+
+
+@app.get("/export-jobs/{job_id}")
+async def export_job_status(job_id: str):
+    job = export_jobs.jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404,
+                            content={"error": f"Export job {job_id} not found"})
+    return job.summary()
+
+
+@app.get("/export-jobs/{job_id}/download")
+async def download_export_job(job_id: str, request: Request):
+    job = export_jobs.jobs.get(job_id)
+    if job is None or job.status != 'done':
+        return JSONResponse(status_code=404,
+                            content={"error": f"Export job {job_id} is not ready"})
+
+    size = os.path.getsize(job.path)
+    headers = {"Accept-Ranges": "bytes",
+               "Content-Disposition": f"attachment; filename=download.{job.extension}"}
+    start, end, status_code = 0, size - 1, 200
+    range_header = request.headers.get('range')
+    if range_header:
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            return JSONResponse(status_code=416,
+                                content={"error": "Invalid range"},
+                                headers={"Content-Range": f"bytes */{size}"})
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return ClosingStreamingResponse(read_file(job.path, start, end),
+                                    status_code=status_code,
+                                    media_type=job.media_type,
+                                    headers=headers)
+
+
+def listing_body(spec):
+    with profile_phase('query_build'):
+        return build_query(spec,
+                           search_indexes.resolve(spec.index, spec.search))
+
+
+async def fetch_hits(spec, offset=0, limit=15, fields=()):
+    body = listing_body(spec)
+    if fields:
+        body["_source"] = source_filter(fields)
+    response = await single_flight.do(
+        ('hits', spec, offset, limit, fields),
+        lambda: es.search(index=spec.index, sort=spec.sort_param,
+                          from_=offset, size=limit, body=body,
+                          track_total_hits=False))
+    return response['hits']['hits']
+
+
+async def fetch_facets(spec):
+    # aggregations do not depend on the sort
+    cache_key = spec.without_sort()
+    aggregations = facet_cache.get(cache_key)
+    if aggregations is None:
+        body = listing_body(spec)
+        body["aggs"] = build_aggregations(spec.index, spec.current_class)
+        response = await single_flight.do(
+            ('facets', cache_key),
+            lambda: es.search(index=spec.index, size=0, body=body))
+        aggregations = response['aggregations']
+        facet_cache.set(cache_key, aggregations)
+    return aggregations
 
-    if 'data_portal' in index or 'tracking_status' in index:
-        body["aggs"]["genome_notes"] = {
-            "nested": {"path": "genome_notes"},
-            "aggs": {
-                "genome_count": {
-                    "reverse_nested": {},  # get to the parent document level
-                    "aggs": {
-                        "distinct_docs": {
-                            "cardinality": {
-                                "field": "id"
-                            }
-                        }
-                    }
-                }
-            }
-        }
 
-        body["aggs"]["taxonomies"] = {
-            "nested": {"path": f"taxonomies.{current_class}"},
-            "aggs": {current_class: {
-                "terms": {
-                    "field": f"taxonomies.{current_class}.scientificName"
-                }
-            }
-            }
-        }
+async def fetch_count(spec):
+    response = await single_flight.do(
+        ('count', spec.without_sort()),
+        lambda: es.count(index=spec.index, body=listing_body(spec) or None))
+    return response['count']
 
-        if phylogeny_filters:
-            body["query"] = {
-                "bool": {
-                    "filter": list()
-                }
-            }
-            phylogeny_filters = phylogeny_filters.split("-")
-            for phylogeny_filter in phylogeny_filters:
-                name, value = phylogeny_filter.split(":")
-                nested_dict = {
-                    "nested": {
-                        "path": f"taxonomies.{name}",
-                        "query": {
-                            "bool": {
-                                "filter": list()
-                            }
-                        }
-                    }
-                }
-                nested_dict["nested"]["query"]["bool"]["filter"].append(
-                    {
-                        "term": {
-                            f"taxonomies.{name}.scientificName": value
-                        }
-                    }
-                )
-                body["query"]["bool"]["filter"].append(nested_dict)
 
-    # adding filters, format: filter_name1:filter_value1, etc...
-    if filter:
-        filters = filter.split(",")
-        if 'query' not in body:
-            body["query"] = {
-                "bool": {
-                    "filter": list()
-                }
-            }
-        for filter_item in filters:
-            if current_class in filter_item:
-                _, value = filter_item.split(":")
-                nested_dict = {
-                    "nested": {
-                        "path": f"taxonomies.{current_class}",
-                        "query": {
-                            "bool": {
-                                "filter": list()
-                            }
-                        }
-                    }
-                }
-                nested_dict["nested"]["query"]["bool"]["filter"].append(
-                    {
-                        "term": {
-                            f"taxonomies.{current_class}.scientificName": value
-                        }
-                    }
-                )
-                body["query"]["bool"]["filter"].append(nested_dict)
-
-            else:
-                filter_name, filter_value = filter_item.split(":")
-
-                if filter_name == 'experimentType':
-                    nested_dict = {
-                        "nested": {
-                            "path": "experiment",
-                            "query": {
-                                "bool": {
-                                    "filter": {
-                                        "term": {
-                                            "experiment"
-                                            ".library_construction_protocol"
-                                            ".keyword": filter_value
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    }
-                    body["query"]["bool"]["filter"].append(nested_dict)
-                elif filter_name == 'genome_notes':
-                    nested_dict = {
-                        'nested': {'path': 'genome_notes', 'query': {
-                            'bool': {
-                                'must': [
-                                    {'exists': {
-                                        'field': 'genome_notes.url'}}]}}}}
-                    body["query"]["bool"]["filter"].append(nested_dict)
-                else:
-                    body["query"]["bool"]["filter"].append(
-                        {"term": {filter_name: filter_value}})
+async def fetch_cursor_page(spec, cursor, limit, body, track_total_hits):
+    # one page of a cursor walk: '*' opens a point in time, every other
+    # cursor resumes with search_after from the last hit of its page
+    fingerprint = spec.fingerprint
+    if cursor == '*':
+        pit_id, search_after = None, None
+    else:
+        pit_id, search_after = decode_cursor(cursor, fingerprint)
+    body = dict(body, size=limit, track_total_hits=track_total_hits,
+                sort=parse_sort(spec.sort_param) + [{"_shard_doc": "asc"}])
+    if search_after is not None:
+        body["search_after"] = search_after
+
+    if pit_id is None:
+        keep_alive = CURSOR_FIRST_KEEP_ALIVE
+        pit = await es.open_point_in_time(index=spec.index,
+                                          keep_alive=keep_alive)
+        pit_id = pit['id']
+    else:
+        keep_alive = CURSOR_KEEP_ALIVE
+    body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+    try:
+        response = await es.search(body=body)
+    except NotFoundError:
+        if search_after is None:
+            raise
+        # the point in time expired between two pages; the sort values of
+        # the cursor, tiebreaker included, mean nothing in another one
+        raise CursorExpired("Cursor expired, start again with cursor=*")
+
+    pit_id = response.get('pit_id', pit_id)
+    hits = response['hits']['hits']
+    if hits and len(hits) == limit:
+        return response, encode_cursor(pit_id, hits[-1]['sort'], fingerprint)
+    try:
+        await close_pit(es, pit_id)
+    except NotFoundError:
+        pass
+    return response, None
 
-    # Adding search string
-    if search:
-        if "query" not in body:
-            body["query"] = {"bool": {"must": {"bool": {"should": []}}}}
-        else:
-            body["query"]["bool"].setdefault("must", {"bool": {"should": []}})
 
-        search_fields = (
-            ["title", "journal_name", "study_id", "organism_name"]
-            if 'articles' in index
-            else ["organism", "commonName", "symbionts_records.organism.text"]
-        )
+@app.get("/{index}")
+async def root(index: str, offset: int = 0, limit: int = 15,
+               sort: str | None = None, filter: str | None = None,
+               search: str | None = None, current_class: str = 'kingdom',
+               phylogeny_filters: str | None = None, action: str = None,
+               stage: str | None = None, fields: str | None = None,
+               cursor: str | None = None):
+    # stage: 'hits', 'facets' or 'count' returns only that part of the
+    # listing, without it all three are returned; fields: comma separated
+    # _source fields to return, "-field" leaves a field out; cursor: '*'
+    # for the first page, then the `next` of the previous page, pages
+    # through the hits instead of offset
+    if index == 'favicon.ico':
+        return None
 
-        for field in search_fields:
-            body["query"]["bool"]["must"]["bool"]["should"].append({
-                "wildcard": {
-                    field: {
-                        "value": f"*{search}*",
-                        "case_insensitive": True
-                    }
-                }
-            })
+    with profile_phase('query_build'):
+        spec = query_spec(index, filter, search, current_class,
+                          phylogeny_filters, sort)
+        fields = normalize_fields(fields)
+
+    if cursor is not None and stage in (None, 'hits'):
+        try:
+            return json_response(await cursor_listing(
+                spec, cursor, limit, fields, stage is None))
+        except CursorExpired as e:
+            return JSONResponse(status_code=410, content={"error": str(e)})
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
 
     if action == 'download':
         try:
-            response = await es.search(index=index, sort=sort, from_=offset,
-                                       body=body, size=limit)
+            return json_response({'results': await fetch_hits(spec, offset, limit, fields)})
         except ConnectionTimeout:
             return {"error": "Request to Elasticsearch timed out."}
-    else:
-        response = await es.search(index=index, sort=sort, from_=offset,
-                                   size=limit, body=body)
-
+    elif stage == 'hits':
+        return json_response({'results': await fetch_hits(spec, offset, limit, fields)})
+    elif stage == 'facets':
+        return json_response({'aggregations': await fetch_facets(spec)})
+    elif stage == 'count':
+        return json_response({'count': await fetch_count(spec)})
+
+    # all stages in one round trip; aggregations only depend on the query,
+    # not on the page, so they are computed once per query and reused
+    # while paging
+    aggregations = facet_cache.get(spec.without_sort())
+    body = full_listing_body(spec, fields, aggregations)
+    response = await single_flight.do(
+        ('listing', spec, offset, limit, fields, aggregations is None),
+        lambda: es.search(index=index, sort=spec.sort_param, from_=offset,
+                          size=limit, body=body, track_total_hits=True))
+    return json_response(listing_data(spec, response, aggregations))
+
+
+def full_listing_body(spec, fields, aggregations):
+    # hits of the listing, with the aggregations when they are not cached
+    body = listing_body(spec)
+    if aggregations is None:
+        body["aggs"] = build_aggregations(spec.index, spec.current_class)
+    if fields:
+        body["_source"] = source_filter(fields)
+    return body
+
+
+def listing_data(spec, response, aggregations):
+    if aggregations is None:
+        aggregations = response['aggregations']
+        facet_cache.set(spec.without_sort(), aggregations)
     data = dict()
     data['results'] = response['hits']['hits']
-    data['aggregations'] = response['aggregations']
-    if 'articles' in index:
-        data['count'] = response['hits']['total']['value']
-    else:
-        data['count'] = data['aggregations']['biosamples']['buckets'][0]['doc_count']
+    data['aggregations'] = aggregations
+    data['count'] = response['hits']['total']['value']
     return data
 
 
+async def cursor_listing(spec, cursor, limit, fields, with_facets):
+    if not with_facets:
+        body = listing_body(spec)
+        if fields:
+            body["_source"] = source_filter(fields)
+        response, next_cursor = await single_flight.do(
+            ('cursor', spec, cursor, limit, fields, False),
+            lambda: fetch_cursor_page(spec, cursor, limit, body, False))
+        return {'results': response['hits']['hits'], 'next': next_cursor}
+
+    aggregations = facet_cache.get(spec.without_sort())
+    body = full_listing_body(spec, fields, aggregations)
+    response, next_cursor = await single_flight.do(
+        ('cursor', spec, cursor, limit, fields, aggregations is None),
+        lambda: fetch_cursor_page(spec, cursor, limit, body, True))
+    data = listing_data(spec, response, aggregations)
+    data['next'] = next_cursor
+    return data
 
-@app.get("/{index}/{record_id}")
-async def details(index: str, record_id: str):
-    body = dict()
-    if 'data_portal' in index:
-        body["query"] = {
-            "bool": {
-                "filter": [
-                    {
-                        'term': {
-                            'tax_id': record_id
-                        }
-                    }
-                ]
-            }
-        }
-        body["aggs"] = dict()
-        body["aggs"]["metadata_filters"] = {
-            'nested': {'path': 'records'},
-            "aggs": {
-                'sex_filter': {
-                    'terms': {
-                        'field':
-                            'records.sex.keyword',
-                        'size': 2000}},
-                'tracking_status_filter': {
-                    'terms': {
-                        'field':
-                            'records.'
-                            'trackingSystem.keyword',
-                        'size': 2000}},
-                'organism_part_filter': {
-                    'terms': {
-                        'field': 'records'
-                                 '.organismPart.keyword',
-                        'size': 2000}}
-            }}
-        body["aggs"]["symbionts_filters"] = {
-            'nested': {'path': 'symbionts_records'},
-            "aggs": {
-                'sex_filter': {
-                    'terms': {
-                        'field':
-                            'symbionts_records.sex.keyword',
-                        'size': 2000}},
-                'tracking_status_filter': {
-                    'terms': {
-                        'field':
-                            'symbionts_records.'
-                            'trackingSystem.keyword',
-                        'size': 2000}},
-                'organism_part_filter': {
-                    'terms': {
-                        'field': 'symbionts_records'
-                                 '.organismPart.keyword',
-                        'size': 2000}}
-            }}
-        body['aggs']['metagenomes_filters'] = {
-            'nested': {'path': 'metagenomes_records'},
-            "aggs": {
-                'sex_filter': {
-                    'terms': {
-                        'field':
-                            'metagenomes_records.sex.keyword',
-                        'size': 2000}},
-                'tracking_status_filter': {
-                    'terms': {
-                        'field':
-                            'metagenomes_records.'
-                            'trackingSystem.keyword',
-                        'size': 2000}},
-                'organism_part_filter': {
-                    'terms': {
-                        'field': 'metagenomes_records'
-                                 '.organismPart.keyword',
-                        'size': 2000}}
-            }}
-
-        response = await es.search(index=index, body=body)
-        aggregations = response['aggregations']
-    else:
-        response = await es.search(index=index, q=f"_id:{record_id}")
+
+def details_response(index, response):
     data = dict()
     data['count'] = response['hits']['total']['value']
     data['results'] = response['hits']['hits']
     if 'data_portal' in index:
-        data['aggregations'] = aggregations
+        data['aggregations'] = response['aggregations']
     return data
 
 
+@app.get("/{index}/{record_id}")
+async def details(index: str, record_id: str, fields: str | None = None):
+    # fields: comma separated _source fields to return, as for listings;
+    # the record aggregations are computed either way
+    fields = normalize_fields(fields)
+    cache_key = (index, record_id, fields) if fields else (index, record_id)
+    data = details_cache.get(cache_key)
+    if data is None:
+        body = build_details_query(index, record_id)
+        if fields:
+            body["_source"] = source_filter(fields)
+        response = await single_flight.do(
+            ('details', index, record_id, fields),
+            lambda: es.search(index=index, body=body))
+        data = details_response(index, response)
+        details_cache.set(cache_key, data)
+    return json_response(data)
+
+
+class RecordIds(BaseModel):
+    record_ids: list[str]
+
+
+DETAILS_BATCH_MAX_IDS = int(os.getenv('DETAILS_BATCH_MAX_IDS', 100))
+
+
+@app.post("/{index}/details")
+async def details_batch(index: str, item: RecordIds):
+    # many detail pages at once: cached records are returned as they are,
+    # the rest are fetched together with a single msearch
+    record_ids = list(dict.fromkeys(item.record_ids))
+    if len(record_ids) > DETAILS_BATCH_MAX_IDS:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"At most {DETAILS_BATCH_MAX_IDS} record ids "
+                              f"per request"})
+    results = dict()
+    missing = []
+    for record_id in record_ids:
+        results[record_id] = details_cache.get((index, record_id))
+        if results[record_id] is None:
+            missing.append(record_id)
+
+    if missing:
+        searches = []
+        for record_id in missing:
+            searches.append({"index": index})
+            searches.append(build_details_query(index, record_id))
+        try:
+            response = await es.msearch(body=searches)
+        except TransportError as e:
+            for record_id in missing:
+                results[record_id] = {"error": str(e)}
+            return json_response({"results": results})
+        for record_id, item_response in zip(missing, response['responses']):
+            if 'error' in item_response:
+                results[record_id] = {"error": item_response['error']}
+                continue
+            data = details_response(index, item_response)
+            details_cache.set((index, record_id), data)
+            results[record_id] = data
+
+    return json_response({"results": results})
+
+
+BATCH_MAX_REQUESTS = int(os.getenv('BATCH_MAX_REQUESTS', 20))
+
+
+class BatchItem(BaseModel):
+    # the query parameters of GET /{index} for a listing, or the path of
+    # GET /{index}/{record_id} for a record; summary needs neither
+    type: str = 'listing'
+    index: str | None = None
+    record_id: str | None = None
+    offset: int = 0
+    limit: int = 15
+    sort: str | None = None
+    filter: str | None = None
+    search: str | None = None
+    current_class: str = 'kingdom'
+    phylogeny_filters: str | None = None
+    fields: str | None = None
+
+
+class BatchRequest(BaseModel):
+    requests: dict[str, BatchItem]
+
+
+def batch_search(key, item, results):
+    # (msearch header and body, function turning its response into the
+    # result) of a sub-request; cached and invalid ones are answered here
+    if item.type == 'summary':
+        results[key] = {"results": summary_snapshot.value,
+                        "snapshot_age": round(summary_snapshot.age, 3)}
+        return None
+    if not item.index:
+        results[key] = {"error": "index is required"}
+        return None
 
-async def fetch_data_in_batches(item: QueryParam):
-    offset = 0
-    batch_size = 1000
-    all_data = []
-
-    while True:
-
-        data = await root(
-            item.index_name, offset, batch_size,
-            item.sortValue, item.filterValue,
-            item.searchValue, item.currentClass,
-            item.phylogeny_filters, 'download'
-        )
-
+    if item.type == 'details':
+        if not item.record_id:
+            results[key] = {"error": "record_id is required"}
+            return None
+        cache_key = (item.index, item.record_id)
+        results[key] = details_cache.get(cache_key)
+        if results[key] is not None:
+            return None
+
+        def details_result(response):
+            data = details_response(item.index, response)
+            details_cache.set(cache_key, data)
+            return data
+        return ({"index": item.index},
+                build_details_query(item.index, item.record_id),
+                details_result)
+
+    if item.type == 'listing':
+        spec = query_spec(item.index, item.filter, item.search,
+                          item.current_class, item.phylogeny_filters,
+                          item.sort)
+        aggregations = facet_cache.get(spec.without_sort())
+        body = full_listing_body(spec, normalize_fields(item.fields),
+                                 aggregations)
+        body.update({"from": item.offset, "size": item.limit,
+                     "track_total_hits": True})
+        if spec.sort:
+            body["sort"] = parse_sort(spec.sort_param)
+        return ({"index": item.index}, body,
+                lambda response: listing_data(spec, response, aggregations))
+
+    results[key] = {"error": f"Unknown request type {item.type}"}
+    return None
+
+
+@app.post("/batch")
+async def batch(item: BatchRequest):
+    # listings, records and the summary of a page in one round trip: every
+    # sub-request that needs ES goes into a single msearch, and a failing
+    # one only fails its own result
+    if len(item.requests) > BATCH_MAX_REQUESTS:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"At most {BATCH_MAX_REQUESTS} requests "
+                              f"per batch"})
+    summary_error = None
+    if any(sub.type == 'summary' for sub in item.requests.values()):
+        try:
+            await summary_snapshot.get()
+        except (TransportError, PoolBusy, DeadlineExceeded) as e:
+            # only fails the summary entries
+            summary_error = {"error": str(e)}
+
+    results = dict()
+    pending = []
+    searches = []
+    for key, sub in item.requests.items():
+        if sub.type == 'summary' and summary_error is not None:
+            results[key] = summary_error
+            continue
+        search = batch_search(key, sub, results)
+        if search is not None:
+            header, body, to_result = search
+            searches.extend((header, body))
+            pending.append((key, to_result))
+
+    if pending:
+        try:
+            response = await es.msearch(body=searches)
+        except TransportError as e:
+            for key, _ in pending:
+                results[key] = {"error": str(e)}
+        else:
+            for (key, to_result), item_response in zip(
+                    pending, response['responses']):
+                if 'error' in item_response:
+                    results[key] = {"error": item_response['error']}
+                else:
+                    results[key] = to_result(item_response)
 
-        results = data.get('results', [])
-        if not results:
-            break
+    return json_response({"results": results})
 
-        all_data.extend(results)
-        offset += batch_size
-        print(f"Fetched {len(results)} results, total: {len(all_data)}")
 
-    return all_data
\ No newline at end of file
+async def fetch_data_in_batches(item: QueryParam, export_format='csv',
+                                on_progress=None):
+    batch_size = 1000
+    total = 0
+    spec = query_spec(item.index_name, item.filterValue, item.searchValue,
+                      item.currentClass, item.phylogeny_filters,
+                      item.sortValue)
+
+    body = listing_body(spec)
+    # only the fields written to the file are fetched
+    source_fields = export_source_fields(
+        export_format, get_csv_columns(item.downloadOption, item.index_name))
+    if source_fields is not None:
+        body["_source"] = source_fields
+
+    slices = min(item.slices or EXPORT_SLICES, EXPORT_MAX_SLICES)
+    # only the first page can be turned away by a busy bulk pool or run
+    # into the request deadline, the rest of the file is already being
+    # written; a failure after that is raised, so the download is aborted
+    # rather than ending as a complete looking, truncated file
+    export = Admission()
+    admission.set(export)
+    pages = iterate_sliced_pages(es, item.index_name, body,
+                                 sort=spec.sort_param, page_size=batch_size,
+                                 slices=slices,
+                                 concurrency=EXPORT_SLICE_CONCURRENCY)
+    try:
+        async for results in pages:
+            export.started = True
+            total += len(results)
+            export_rows.inc(index_label(item.index_name), export_format,
+                            amount=len(results))
+            if on_progress:
+                on_progress(total)
+            yield results
+    except (ConnectionTimeout, DeadlineExceeded):
+        logger.warning("Export of %s failed after %d rows", item.index_name,
+                       total)
+        raise
+    finally:
+        await pages.aclose()
@@ -0,0 +1,180 @@
+import time
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216, 67108864)
+
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{label_value(value)}"'
+                          for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = dict()
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # label values: [count per bucket (the last one is +Inf), sum]
+        self.series = dict()
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = \
+                [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = format_labels(self.labels, label_values,
+                                       [("le", bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge:
+    # current values, read from `collect` (label values: value) when the
+    # metrics are rendered
+    def __init__(self, name, documentation, labels, collect):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.collect = collect
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for label_values, value in self.collect().items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+
+http_request_duration = Histogram(
+    'http_request_duration_seconds',
+    'Time from receiving a request to the end of its response',
+    ('method', 'route', 'status'))
+http_response_size = Histogram(
+    'http_response_size_bytes', 'Size of response bodies', ('route',),
+    buckets=SIZE_BUCKETS)
+es_request_duration = Histogram(
+    'es_request_duration_seconds',
+    'Wall-clock time of Elasticsearch requests, including the network',
+    ('index', 'operation'))
+es_took = Histogram(
+    'es_took_seconds', 'Time Elasticsearch reported spending on requests',
+    ('index', 'operation'))
+es_request_errors = Counter(
+    'es_request_errors_total',
+    'Failed Elasticsearch requests, ConnectionTimeout included',
+    ('index', 'operation', 'error'))
+export_rows = Counter(
+    'export_rows_total', 'Rows fetched for exports and downloads',
+    ('index', 'format'))
+
+METRICS = [http_request_duration, http_response_size, es_request_duration,
+           es_took, es_request_errors, export_rows]
+
+
+def register(metric):
+    METRICS.append(metric)
+    return metric
+
+
+def render_metrics():
+    return "\n".join(line for metric in METRICS
+                     for line in metric.render()) + "\n"
+
+
+# values of the `index` label; any other index, e.g. from a mistyped
+# /{index} path, is counted as 'other' so that requests can't add series
+# without limit
+known_indexes = set()
+
+
+def index_label(index):
+    return index if not index or index in known_indexes else 'other'
+
+
+def es_operation(method, url):
+    # (index, operation) labels of a request path such as
+    # /data_portal/_search; searches with a point in time have no index
+    index, operation = "", "info"
+    for segment in url.split("?")[0].strip("/").split("/"):
+        if segment.startswith("_"):
+            operation = segment[1:]
+            break
+        if segment and not index:
+            index = segment
+    if operation == 'pit':
+        operation = 'close_pit' if method == 'DELETE' else 'open_pit'
+    return index_label(index), operation
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every response until its last byte and
+    counting the bytes sent, streamed responses included.
+    """
+
+    def __init__(self, app, route_of):
+        self.app = app
+        self.route_of = route_of
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        route = self.route_of(scope)
+        status = 500
+        size = 0
+
+        async def send_counted(message):
+            nonlocal status, size
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                size += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_counted)
+        finally:
+            http_request_duration.observe(time.perf_counter() - started,
+                                          scope['method'], route, status)
+            http_response_size.observe(size, route)
@@ -0,0 +1,217 @@
+import asyncio
+import base64
+import binascii
+import heapq
+
+import orjson
+
+PIT_KEEP_ALIVE = '2m'
+
+
+def parse_sort(sort):
+    # "field1:asc,field2:desc" (the format of the `sort` query parameter)
+    # into the body representation used with search_after
+    sort_list = []
+    if not sort:
+        return sort_list
+    for sort_item in sort.split(","):
+        if not sort_item.strip():
+            continue
+        field, _, order = sort_item.partition(":")
+        sort_list.append({field.strip(): order.strip() or "asc"})
+    return sort_list
+
+
+async def iterate_pages(es, index, body, sort=None, page_size=1000,
+                        keep_alive=PIT_KEEP_ALIVE):
+    # Walks every hit matching `body` with a point-in-time and search_after,
+    # so each page costs the same regardless of how deep it is and the
+    # result set is not limited by max_result_window. _shard_doc is the
+    # tiebreaker that makes the sort total.
+    pit = await es.open_point_in_time(index=index, keep_alive=keep_alive)
+    pit_id = pit['id']
+    search_after = None
+    try:
+        while True:
+            page_body = dict(body)
+            page_body["size"] = page_size
+            page_body["sort"] = parse_sort(sort) + [{"_shard_doc": "asc"}]
+            page_body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+            page_body["track_total_hits"] = False
+            if search_after is not None:
+                page_body["search_after"] = search_after
+
+            response = await es.search(body=page_body)
+            pit_id = response.get('pit_id', pit_id)
+            hits = response['hits']['hits']
+            if not hits:
+                break
+            yield hits
+            if len(hits) < page_size:
+                break
+            search_after = hits[-1]['sort']
+    finally:
+        await close_pit(es, pit_id)
+
+
+async def close_pit(es, pit_id):
+    # shielded, so the point in time is released even when the walk is
+    # abandoned half way because the request was cancelled
+    await asyncio.shield(es.close_point_in_time(body={"id": pit_id}))
+
+
+class Descending:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def merge_key(hit, orders):
+    # comparable form of a hit's sort values; missing values sort last in
+    # either direction, as they do in Elasticsearch
+    key = []
+    for value, order in zip(hit['sort'], orders):
+        if value is None:
+            key.append((True, None))
+        else:
+            key.append((False, Descending(value) if order == 'desc' else value))
+    return key
+
+
+async def iterate_sliced_pages(es, index, body, sort=None, page_size=1000,
+                               slices=4, concurrency=4,
+                               keep_alive=PIT_KEEP_ALIVE):
+    # Same walk as iterate_pages, split into `slices` PIT slices that are
+    # fetched concurrently, at most `concurrency` requests at a time. With a
+    # sort the slices are merged back in order, without one pages are
+    # yielded in whatever order they arrive.
+    if slices <= 1:
+        pages = iterate_pages(es, index, body, sort, page_size, keep_alive)
+        try:
+            async for hits in pages:
+                yield hits
+        finally:
+            await pages.aclose()
+        return
+
+    sort_list = parse_sort(sort)
+    orders = [order for sort_item in sort_list for order in sort_item.values()]
+    pit = await es.open_point_in_time(index=index, keep_alive=keep_alive)
+    pit_id = pit['id']
+    semaphore = asyncio.Semaphore(concurrency)
+    shared_queue = asyncio.Queue(maxsize=concurrency * 2)
+    queues = [asyncio.Queue(maxsize=2) for _ in range(slices)] \
+        if sort_list else [shared_queue] * slices
+
+    async def walk(slice_id):
+        queue = queues[slice_id]
+        search_after = None
+        try:
+            while True:
+                page_body = dict(body)
+                page_body["size"] = page_size
+                page_body["sort"] = sort_list + [{"_shard_doc": "asc"}]
+                page_body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+                page_body["slice"] = {"id": slice_id, "max": slices}
+                page_body["track_total_hits"] = False
+                if search_after is not None:
+                    page_body["search_after"] = search_after
+                async with semaphore:
+                    response = await es.search(body=page_body)
+                hits = response['hits']['hits']
+                if hits:
+                    await queue.put(hits)
+                if len(hits) < page_size:
+                    break
+                search_after = hits[-1]['sort']
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(None)
+
+    async def next_page(queue):
+        hits = await queue.get()
+        if isinstance(hits, Exception):
+            raise hits
+        return hits
+
+    tasks = [asyncio.ensure_future(walk(slice_id))
+             for slice_id in range(slices)]
+    try:
+        if not sort_list:
+            remaining = slices
+            while remaining:
+                hits = await next_page(shared_queue)
+                if hits is None:
+                    remaining -= 1
+                else:
+                    yield hits
+            return
+
+        pages = dict()
+        heap = []
+        for slice_id, queue in enumerate(queues):
+            hits = await next_page(queue)
+            if hits:
+                pages[slice_id] = hits
+                heapq.heappush(heap, (merge_key(hits[0], orders), slice_id, 0))
+        merged = []
+        while heap:
+            _, slice_id, position = heapq.heappop(heap)
+            merged.append(pages[slice_id][position])
+            if len(merged) == page_size:
+                yield merged
+                merged = []
+            position += 1
+            if position == len(pages[slice_id]):
+                hits = await next_page(queues[slice_id])
+                if not hits:
+                    continue
+                pages[slice_id] = hits
+                position = 0
+            heapq.heappush(heap, (merge_key(pages[slice_id][position], orders),
+                                  slice_id, position))
+        if merged:
+            yield merged
+    finally:
+        for task in tasks:
+            task.cancel()
+        try:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # a cancelled request gets cancelled again on every await
+            await close_pit(es, pit_id)
+
+
+class CursorExpired(Exception):
+    pass
+
+
+def encode_cursor(pit_id, search_after, fingerprint):
+    # opaque, url safe token for the page following the hit whose sort
+    # values are `search_after`
+    token = orjson.dumps({"pit": pit_id, "after": search_after,
+                          "query": fingerprint})
+    return base64.urlsafe_b64encode(token).decode('ascii').rstrip("=")
+
+
+def decode_cursor(cursor, fingerprint):
+    # (pit id, search_after) of a token from encode_cursor; ValueError when
+    # it is malformed or was issued for another query
+    try:
+        token = orjson.loads(base64.urlsafe_b64decode(
+            cursor + "=" * (-len(cursor) % 4)))
+        pit_id, search_after = token["pit"], token["after"]
+        query = token["query"]
+    except (binascii.Error, orjson.JSONDecodeError, KeyError, TypeError):
+        raise ValueError(f"Invalid cursor {cursor}")
+    if query != fingerprint or not isinstance(search_after, list):
+        raise ValueError("Cursor does not belong to this query")
+    return pit_id, search_after
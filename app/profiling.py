@@ -0,0 +1,55 @@
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+# profile of the request being served, None unless profiling was asked for
+current_profile = ContextVar('current_profile', default=None)
+
+
+class Profile:
+    """Time spent per phase of one request, reported as Server-Timing.
+
+    Elasticsearch calls add their round trip and `took`; with `es_profile`
+    searches are sent with the profile API on and its output is kept.
+    """
+
+    def __init__(self, es_profile=False):
+        self.es_profile = es_profile
+        self.started = time.perf_counter()
+        self.phases = dict()
+        self.es_calls = 0
+        self.es_took = 0
+        self.es_profiles = []
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def record_es(self, response):
+        self.es_calls += 1
+        if isinstance(response, dict):
+            self.es_took += response.get('took') or 0
+            if 'profile' in response:
+                self.es_profiles.append(response['profile'])
+
+    def server_timing(self):
+        metrics = [f"{name};dur={seconds * 1000:.2f}"
+                   for name, seconds in self.phases.items()]
+        if self.es_calls:
+            metrics.append(f'es_took;dur={self.es_took};'
+                           f'desc="{self.es_calls} ES calls"')
+        total = time.perf_counter() - self.started
+        metrics.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(metrics)
+
+
+def profile_phase(name):
+    profile = current_profile.get()
+    return profile.phase(name) if profile is not None else nullcontext()
@@ -0,0 +1,340 @@
+import hashlib
+from typing import NamedTuple
+
+from .constants import DATA_PORTAL_AGGREGATIONS, ARTICLES_AGGREGATIONS, \
+    DATA_PORTAL_SEARCH_FIELDS, ARTICLES_SEARCH_FIELDS
+from .pagination import parse_sort
+
+
+def build_aggregations(index, current_class):
+    aggs = dict()
+    if 'articles' in index:
+        aggregations_list = ARTICLES_AGGREGATIONS
+    else:
+        aggregations_list = DATA_PORTAL_AGGREGATIONS
+
+    for aggregation_field in aggregations_list:
+        aggs[aggregation_field] = {
+            "terms": {"field": aggregation_field, "size": 20}
+        }
+    if 'data_portal' in index:
+        aggs["experiment"] = {
+            "nested": {"path": "experiment"},
+            "aggs": {
+                "library_construction_protocol": {
+                    "terms": {
+                        "field": "experiment.library_construction_protocol.keyword",
+                        "size": 20
+                    },
+                    "aggs": {
+                        "distinct_docs": {
+                            "reverse_nested": {},
+                            # get to the parent document level to count number of docs instead of
+                            # number of terms
+                            "aggs": {
+                                "parent_doc_count": {
+                                    "cardinality": {
+                                        "field": "tax_id"
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+
+    if 'data_portal' in index or 'tracking_status' in index:
+        aggs["genome_notes"] = {
+            "nested": {"path": "genome_notes"},
+            "aggs": {
+                "genome_count": {
+                    "reverse_nested": {},  # get to the parent document level
+                    "aggs": {
+                        "distinct_docs": {
+                            "cardinality": {
+                                "field": "id"
+                            }
+                        }
+                    }
+                }
+            }
+        }
+
+        aggs["taxonomies"] = {
+            "nested": {"path": f"taxonomies.{current_class}"},
+            "aggs": {current_class: {
+                "terms": {
+                    "field": f"taxonomies.{current_class}.scientificName"
+                }
+            }
+            }
+        }
+    return aggs
+
+
+class QuerySpec(NamedTuple):
+    # canonical form of the listing inputs: filters are ANDed so they are
+    # kept sorted, sort keeps its order, whitespace is stripped everywhere
+    index: str
+    filters: tuple = ()
+    phylogeny: tuple = ()
+    search: str = ''
+    sort: tuple = ()
+    current_class: str = 'kingdom'
+
+    @property
+    def sort_param(self):
+        # the `sort` query parameter format expected by es.search
+        return ",".join(f"{field}:{order}" for field, order in self.sort) \
+            or None
+
+    def without_sort(self):
+        return self._replace(sort=())
+
+    @property
+    def fingerprint(self):
+        # identifies the hits and their order, for cursors to be checked
+        # against the query they are used with
+        hits = (self.index, self.filters, self.phylogeny, self.search,
+                self.sort)
+        return hashlib.sha1(repr(hits).encode('utf-8')).hexdigest()[:16]
+
+
+def normalize_fields(fields):
+    # "a, b,-c" -> ('-c', 'a', 'b'); a leading "-" excludes the field
+    return tuple(sorted({field.strip() for field in (fields or '').split(",")
+                         if field.strip().lstrip("-")}))
+
+
+def source_filter(fields):
+    # _source filtering for the output of normalize_fields
+    if not fields:
+        return None
+    return {"includes": [field for field in fields if not field.startswith("-")],
+            "excludes": [field[1:] for field in fields if field.startswith("-")]}
+
+
+def split_pairs(value, separator):
+    pairs = set()
+    for item in (value or '').split(separator):
+        if not item.strip():
+            continue
+        name, _, item_value = item.partition(":")
+        pairs.add((name.strip(), item_value.strip()))
+    return tuple(sorted(pairs))
+
+
+def query_spec(index, filter=None, search=None, current_class='kingdom',
+               phylogeny_filters=None, sort=None):
+    return QuerySpec(
+        index=index,
+        filters=split_pairs(filter, ","),
+        phylogeny=split_pairs(phylogeny_filters, "-"),
+        search=(search or '').strip(),
+        sort=tuple((field, order) for sort_item in parse_sort(sort)
+                   for field, order in sort_item.items()),
+        current_class=(current_class or '').strip() or 'kingdom')
+
+
+def build_query(spec: QuerySpec, search_ids=None):
+    index = spec.index
+    current_class = spec.current_class
+    # data structure for ES query
+    body = dict()
+
+    if ('data_portal' in index or 'tracking_status' in index) and spec.phylogeny:
+        body["query"] = {
+            "bool": {
+                "filter": list()
+            }
+        }
+        for name, value in spec.phylogeny:
+            nested_dict = {
+                "nested": {
+                    "path": f"taxonomies.{name}",
+                    "query": {
+                        "bool": {
+                            "filter": list()
+                        }
+                    }
+                }
+            }
+            nested_dict["nested"]["query"]["bool"]["filter"].append(
+                {
+                    "term": {
+                        f"taxonomies.{name}.scientificName": value
+                    }
+                }
+            )
+            body["query"]["bool"]["filter"].append(nested_dict)
+
+    # adding filters, format: filter_name1:filter_value1, etc...
+    if spec.filters:
+        if 'query' not in body:
+            body["query"] = {
+                "bool": {
+                    "filter": list()
+                }
+            }
+        for filter_name, filter_value in spec.filters:
+            if current_class in f"{filter_name}:{filter_value}":
+                nested_dict = {
+                    "nested": {
+                        "path": f"taxonomies.{current_class}",
+                        "query": {
+                            "bool": {
+                                "filter": list()
+                            }
+                        }
+                    }
+                }
+                nested_dict["nested"]["query"]["bool"]["filter"].append(
+                    {
+                        "term": {
+                            f"taxonomies.{current_class}.scientificName": filter_value
+                        }
+                    }
+                )
+                body["query"]["bool"]["filter"].append(nested_dict)
+
+            elif filter_name == 'experimentType':
+                nested_dict = {
+                    "nested": {
+                        "path": "experiment",
+                        "query": {
+                            "bool": {
+                                "filter": {
+                                    "term": {
+                                        "experiment"
+                                        ".library_construction_protocol"
+                                        ".keyword": filter_value
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+                body["query"]["bool"]["filter"].append(nested_dict)
+            elif filter_name == 'genome_notes':
+                nested_dict = {
+                    'nested': {'path': 'genome_notes', 'query': {
+                        'bool': {
+                            'must': [
+                                {'exists': {
+                                    'field': 'genome_notes.url'}}]}}}}
+                body["query"]["bool"]["filter"].append(nested_dict)
+            else:
+                body["query"]["bool"]["filter"].append(
+                    {"term": {filter_name: filter_value}})
+
+    # Adding search string
+    search = spec.search
+    if search:
+        if "query" not in body:
+            body["query"] = {"bool": {"must": {"bool": {"should": []}}}}
+        else:
+            body["query"]["bool"].setdefault("must", {"bool": {"should": []}})
+
+        search_fields = (
+            ARTICLES_SEARCH_FIELDS
+            if 'articles' in index
+            else DATA_PORTAL_SEARCH_FIELDS
+        )
+
+        if search_ids is not None:
+            # already resolved by the in-process search index
+            body["query"]["bool"]["must"]["bool"]["should"].append(
+                {"terms": {"_id": search_ids}})
+            search_fields = []
+
+        for field in search_fields:
+            body["query"]["bool"]["must"]["bool"]["should"].append({
+                "wildcard": {
+                    field: {
+                        "value": f"*{search}*",
+                        "case_insensitive": True
+                    }
+                }
+            })
+    return body
+
+
+def build_details_query(index, record_id):
+    body = dict()
+    if 'data_portal' in index:
+        body["query"] = {
+            "bool": {
+                "filter": [
+                    {
+                        'term': {
+                            'tax_id': record_id
+                        }
+                    }
+                ]
+            }
+        }
+        body["aggs"] = dict()
+        body["aggs"]["metadata_filters"] = {
+            'nested': {'path': 'records'},
+            "aggs": {
+                'sex_filter': {
+                    'terms': {
+                        'field':
+                            'records.sex.keyword',
+                        'size': 2000}},
+                'tracking_status_filter': {
+                    'terms': {
+                        'field':
+                            'records.'
+                            'trackingSystem.keyword',
+                        'size': 2000}},
+                'organism_part_filter': {
+                    'terms': {
+                        'field': 'records'
+                                 '.organismPart.keyword',
+                        'size': 2000}}
+            }}
+        body["aggs"]["symbionts_filters"] = {
+            'nested': {'path': 'symbionts_records'},
+            "aggs": {
+                'sex_filter': {
+                    'terms': {
+                        'field':
+                            'symbionts_records.sex.keyword',
+                        'size': 2000}},
+                'tracking_status_filter': {
+                    'terms': {
+                        'field':
+                            'symbionts_records.'
+                            'trackingSystem.keyword',
+                        'size': 2000}},
+                'organism_part_filter': {
+                    'terms': {
+                        'field': 'symbionts_records'
+                                 '.organismPart.keyword',
+                        'size': 2000}}
+            }}
+        body['aggs']['metagenomes_filters'] = {
+            'nested': {'path': 'metagenomes_records'},
+            "aggs": {
+                'sex_filter': {
+                    'terms': {
+                        'field':
+                            'metagenomes_records.sex.keyword',
+                        'size': 2000}},
+                'tracking_status_filter': {
+                    'terms': {
+                        'field':
+                            'metagenomes_records.'
+                            'trackingSystem.keyword',
+                        'size': 2000}},
+                'organism_part_filter': {
+                    'terms': {
+                        'field': 'metagenomes_records'
+                                 '.organismPart.keyword',
+                        'size': 2000}}
+            }}
+    else:
+        body["query"] = {"query_string": {"query": f"_id:{record_id}"}}
+    return body
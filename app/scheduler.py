@@ -0,0 +1,158 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextvars import ContextVar
+
+# traffic class of the work running in the current context; requests get
+# theirs from the path, anything started outside a request is background
+traffic_class = ContextVar('traffic_class', default='background')
+
+
+class Admission:
+    # shared by the ES calls of one long running request, including those
+    # of the tasks it starts; once `started` its later calls wait for a
+    # slot as long as their timeout allows instead of the pool's max_wait,
+    # and the request deadline no longer applies to them, since giving up
+    # half way would leave the response cut short
+    __slots__ = ('started',)
+
+    def __init__(self):
+        self.started = False
+
+
+admission = ContextVar('admission', default=None)
+
+
+class PoolBusy(Exception):
+    def __init__(self, pool, status_code):
+        super().__init__(f"Too many {pool.name} requests, try again later")
+        self.pool = pool
+        self.status_code = status_code
+        self.retry_after = max(1, math.ceil(pool.average_wait() or 1))
+
+
+class Pool:
+    def __init__(self, name, priority, max_concurrency, max_queue=None,
+                 max_wait=None):
+        self.name = name
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_seen_wait = 0.0
+
+    def average_wait(self):
+        return self.total_wait / self.admitted if self.admitted else 0.0
+
+    def stats(self):
+        return {"priority": self.priority, "active": self.active,
+                "max_concurrency": self.max_concurrency,
+                "queue_depth": self.waiting, "max_queue": self.max_queue,
+                "admitted": self.admitted, "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "average_wait": round(self.average_wait(), 4),
+                "max_wait": round(self.max_seen_wait, 4)}
+
+
+class Scheduler:
+    """Admits Elasticsearch calls by traffic class.
+
+    Each pool has its own concurrency and queue limits, and all pools
+    share `max_concurrency` slots. Free slots go to the waiter of the
+    highest priority (lowest number) whose pool has room; a full queue
+    raises PoolBusy (429) and so does waiting longer than the pool's
+    max_wait (503).
+    """
+
+    def __init__(self, pools, max_concurrency):
+        self.pools = {pool.name: pool for pool in pools}
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    def _can_run(self, pool):
+        return pool.active < pool.max_concurrency and \
+            self.active < self.max_concurrency
+
+    def _admit(self, pool, waited):
+        pool.active += 1
+        self.active += 1
+        pool.admitted += 1
+        pool.total_wait += waited
+        pool.max_seen_wait = max(pool.max_seen_wait, waited)
+
+    async def acquire(self, name, timeout=None):
+        # timeout: the most the caller can wait, on top of the pool's limit
+        pool = self.pools[name]
+        # waiters stuck only because their own pool is full do not hold
+        # back the other pools
+        queued_ahead = any(
+            priority <= pool.priority and not future.done()
+            and waiting.active < waiting.max_concurrency
+            for priority, _, waiting, future, _ in self._waiters)
+        if self._can_run(pool) and not queued_ahead:
+            self._admit(pool, 0.0)
+            return
+        if pool.max_queue is not None and pool.waiting >= pool.max_queue:
+            pool.rejected += 1
+            raise PoolBusy(pool, 429)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (pool.priority, next(self._sequence),
+                                       pool, future, time.monotonic()))
+        pool.waiting += 1
+        current = admission.get()
+        pool_wait = None if current is not None and current.started \
+            else pool.max_wait
+        max_wait = pool_wait if timeout is None else \
+            min(pool_wait or timeout, timeout)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done():
+                # the slot was handed over just as we gave up on it
+                self.release(name)
+            else:
+                future.cancel()
+                pool.waiting -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                pool.timed_out += 1
+                raise PoolBusy(pool, 503)
+            raise
+
+    def release(self, name):
+        pool = self.pools[name]
+        pool.active -= 1
+        self.active -= 1
+        self._wake()
+
+    def _wake(self):
+        skipped = []
+        while self._waiters and self.active < self.max_concurrency:
+            entry = heapq.heappop(self._waiters)
+            _, _, pool, future, started = entry
+            if future.done():
+                continue
+            if pool.active >= pool.max_concurrency:
+                skipped.append(entry)
+                continue
+            # the slot is taken on behalf of the waiter before it resumes
+            pool.waiting -= 1
+            self._admit(pool, time.monotonic() - started)
+            future.set_result(None)
+        for entry in skipped:
+            heapq.heappush(self._waiters, entry)
+
+    def stats(self):
+        return {"active": self.active, "max_concurrency": self.max_concurrency,
+                "pools": {name: pool.stats()
+                          for name, pool in self.pools.items()}}
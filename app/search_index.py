@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+from array import array
+from bisect import bisect_left
+
+from .constants import DATA_PORTAL_SEARCH_FIELDS, ARTICLES_SEARCH_FIELDS
+from .pagination import iterate_pages
+
+logger = logging.getLogger(__name__)
+
+NGRAM = 3
+WILDCARD_CHARACTERS = ('*', '?')
+
+
+def source_values(source, path):
+    # all values found under a dotted path, walking through nested lists;
+    # multi-fields such as `organism.text` fall back to the parent value
+    values = [source]
+    for part in path.split('.'):
+        next_values = []
+        for value in values:
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, dict):
+                    if part in item:
+                        child = item[part]
+                        next_values.extend(
+                            child if isinstance(child, list) else [child])
+                elif item is not None:
+                    next_values.append(item)
+        values = next_values
+    return [value for value in values
+            if value is not None and not isinstance(value, (dict, list))]
+
+
+def ngrams(term):
+    return {term[i:i + NGRAM] for i in range(len(term) - NGRAM + 1)}
+
+
+class SubstringIndex:
+    """Case-insensitive substring lookup over the searchable names of an
+    index, mapping each distinct name to the ids of its documents.
+
+    Every name is registered under each of its trigrams; a lookup only
+    verifies the names of the query's rarest trigram. Queries shorter
+    than a trigram are served as prefix lookups on the sorted names.
+    """
+
+    def __init__(self, entries):
+        term_ids = dict()
+        names = dict()
+        for doc_id, name in entries:
+            name = str(name).strip()
+            if not name:
+                continue
+            term = name.lower()
+            names.setdefault(term, name)
+            term_ids.setdefault(term, set()).add(doc_id)
+
+        self.terms = list(term_ids)
+        self.names = [names[term] for term in self.terms]
+        self.ids = [tuple(term_ids[term]) for term in self.terms]
+        self.sorted_terms = sorted(
+            (term, position) for position, term in enumerate(self.terms))
+        self.grams = dict()
+        for position, term in enumerate(self.terms):
+            for gram in ngrams(term):
+                self.grams.setdefault(gram, array('I')).append(position)
+        self.documents = len({doc_id for ids in self.ids for doc_id in ids})
+
+    def prefix_matches(self, query):
+        i = bisect_left(self.sorted_terms, (query, -1))
+        while i < len(self.sorted_terms) and \
+                self.sorted_terms[i][0].startswith(query):
+            yield self.sorted_terms[i][1]
+            i += 1
+
+    def substring_matches(self, query):
+        postings = [self.grams.get(gram, ()) for gram in ngrams(query)]
+        candidates = min(postings, key=len)
+        for position in candidates:
+            if query in self.terms[position]:
+                yield position
+
+    def resolve(self, query, max_ids=10000):
+        # ids of the documents with a name containing `query`, or None when
+        # the query has to go to Elasticsearch as a wildcard instead
+        query = query.strip().lower()
+        if len(query) < NGRAM or any(c in query for c in WILDCARD_CHARACTERS):
+            return None
+        ids = set()
+        for position in self.substring_matches(query):
+            ids.update(self.ids[position])
+            if len(ids) > max_ids:
+                return None
+        return sorted(ids)
+
+    def autocomplete(self, query, limit=10):
+        query = query.strip().lower()
+        if not query:
+            return []
+        results = []
+        seen = set()
+        matches = [self.prefix_matches(query)]
+        if len(query) >= NGRAM:
+            matches.append(self.substring_matches(query))
+        for positions in matches:
+            for position in positions:
+                if position in seen:
+                    continue
+                seen.add(position)
+                results.append(self.names[position])
+                if len(results) >= limit:
+                    return results
+        return results
+
+
+class SearchIndexes:
+    def __init__(self, index_names, max_ids=10000):
+        self.index_names = index_names
+        self.max_ids = max_ids
+        self.indexes = dict()
+        self.built_at = dict()
+        self.build_seconds = dict()
+        # monotonic times the current builds started reading at, and the
+        # index last changed at
+        self._built_from = dict()
+        self._changed = dict()
+
+    def mark_changed(self, index):
+        # documents added since the build would not be found, so searches
+        # go to ES as wildcards until a build started after this one is in
+        self._changed[index] = time.monotonic()
+
+    def is_stale(self, index):
+        return self._changed.get(index, float('-inf')) >= \
+            self._built_from.get(index, float('-inf'))
+
+    def resolve(self, index, search):
+        search_index = self.indexes.get(index)
+        if search_index is None or not search or self.is_stale(index):
+            return None
+        return search_index.resolve(search, self.max_ids)
+
+    async def build(self, es, index):
+        started = time.monotonic()
+        fields = ARTICLES_SEARCH_FIELDS if 'articles' in index \
+            else DATA_PORTAL_SEARCH_FIELDS
+        # `organism.text` may be an object field or a multi-field of
+        # `organism`, so the parent is fetched and source_values handles both
+        body = {"_source": [field.removesuffix('.text') for field in fields]}
+        entries = []
+        async for hits in iterate_pages(es, index, body, page_size=5000):
+            for hit in hits:
+                for field in fields:
+                    for value in source_values(hit['_source'], field):
+                        entries.append((hit['_id'], value))
+        search_index = await asyncio.to_thread(SubstringIndex, entries)
+        if started < self._built_from.get(index, float('-inf')):
+            # a build started later has finished first
+            return
+        self.indexes[index] = search_index
+        self._built_from[index] = started
+        self.built_at[index] = time.time()
+        self.build_seconds[index] = time.monotonic() - started
+
+    async def refresh(self, es):
+        for index in self.index_names:
+            try:
+                await self.build(es, index)
+            except Exception as e:
+                # keep serving the previous build, or wildcards without one
+                logger.warning("Building the search index of %s failed: %r",
+                               index, e)
+
+    def stats(self):
+        return {index: {"terms": len(search_index.terms),
+                        "documents": search_index.documents,
+                        "built_at": self.built_at[index],
+                        "stale": self.is_stale(index),
+                        "build_seconds": round(self.build_seconds[index], 3)}
+                for index, search_index in self.indexes.items()}
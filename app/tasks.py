@@ -0,0 +1,60 @@
+import asyncio
+import contextvars
+import logging
+
+from .cancellation import request_deadline
+from .profiling import current_profile
+from .scheduler import admission, traffic_class
+
+logger = logging.getLogger(__name__)
+
+background_tasks = set()
+
+
+async def run_periodically(interval, fn, name):
+    while True:
+        try:
+            await fn()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("%s failed: %r", name, e)
+        await asyncio.sleep(interval)
+
+
+def start_periodic(interval, fn, name):
+    task = asyncio.create_task(run_periodically(interval, fn, name))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def detached_context():
+    # copy of the current context for work that outlives the request which
+    # happens to start it: background traffic, without its deadline
+    context = contextvars.copy_context()
+    context.run(traffic_class.set, 'background')
+    context.run(request_deadline.set, None)
+    context.run(admission.set, None)
+    context.run(current_profile.set, None)
+    return context
+
+
+def start_background(fn, name):
+    # one-off work that nobody waits for
+    async def run():
+        try:
+            await fn()
+        except Exception as e:
+            logger.warning("%s failed: %r", name, e)
+
+    task = detached_context().run(asyncio.create_task, run())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def stop_background_tasks():
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
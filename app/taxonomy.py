@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+from .constants import PHYLOGENETIC_RANKS
+from .pagination import iterate_pages
+from .search_index import source_values
+
+
+class TaxonNode:
+    __slots__ = ('rank', 'name', 'parent', 'children', 'count')
+
+    def __init__(self, rank, name, parent):
+        self.rank = rank
+        self.name = name
+        self.parent = parent
+        self.children = dict()
+        self.count = 0
+
+    def summary(self):
+        return {"rank": self.rank, "name": self.name, "count": self.count,
+                "has_children": bool(self.children)}
+
+
+class TaxonomyTree:
+    """Taxa of the indexed documents keyed by (rank, scientific name), each
+    linked to its parent and children and counting the documents below it.
+    """
+
+    def __init__(self, lineages):
+        self.roots = dict()
+        self.nodes = dict()
+        self.ranks_by_name = dict()
+        self.documents = 0
+        for lineage in lineages:
+            self.add(lineage)
+
+    def add(self, lineage):
+        # lineage: [(rank, name), ...] ordered from kingdom to species
+        self.documents += 1
+        parent = None
+        for rank, name in lineage:
+            node = self.nodes.get((rank, name))
+            if node is None:
+                node = TaxonNode(rank, name, parent)
+                self.nodes[(rank, name)] = node
+                self.ranks_by_name.setdefault(name, []).append(rank)
+                siblings = parent.children if parent else self.roots
+                siblings[(rank, name)] = node
+            node.count += 1
+            parent = node
+
+    def ranks_of(self, name):
+        return self.ranks_by_name.get(name, [])
+
+    def find(self, name, rank=None):
+        ranks = [rank] if rank else self.ranks_of(name)
+        for rank in ranks:
+            node = self.nodes.get((rank, name))
+            if node is not None:
+                return node
+        return None
+
+
+def document_lineage(source):
+    lineage = []
+    for rank in PHYLOGENETIC_RANKS:
+        names = source_values(source, f"taxonomies.{rank}.scientificName")
+        if names:
+            lineage.append((rank, names[0]))
+    return lineage
+
+
+class TaxonomyIndex:
+    def __init__(self, index_name):
+        self.index_name = index_name
+        self.tree = None
+        self.built_at = None
+        self.build_seconds = None
+
+    def ranks_of(self, name):
+        return self.tree.ranks_of(name) if self.tree else []
+
+    async def refresh(self, es):
+        started = time.monotonic()
+        body = {"_source": [f"taxonomies.{rank}.scientificName"
+                            for rank in PHYLOGENETIC_RANKS]}
+        lineages = []
+        async for hits in iterate_pages(es, self.index_name, body,
+                                        page_size=5000):
+            lineages.extend(document_lineage(hit['_source']) for hit in hits)
+        self.tree = await asyncio.to_thread(TaxonomyTree, lineages)
+        self.built_at = time.time()
+        self.build_seconds = time.monotonic() - started
+
+    def stats(self):
+        if self.tree is None:
+            return {"index": self.index_name, "ready": False}
+        return {"index": self.index_name, "ready": True,
+                "taxa": len(self.tree.nodes),
+                "documents": self.tree.documents,
+                "built_at": self.built_at,
+                "build_seconds": round(self.build_seconds, 3)}
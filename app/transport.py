@@ -0,0 +1,75 @@
+import time
+
+from elasticsearch import AsyncTransport
+from elasticsearch.exceptions import ConnectionTimeout
+
+from .cancellation import time_left
+from .metrics import es_operation, es_request_duration, es_request_errors, \
+    es_took
+from .profiling import current_profile, profile_phase
+from .scheduler import admission, traffic_class
+
+
+class ScheduledTransport(AsyncTransport):
+    """Transport sending every request to Elasticsearch with the slot and
+    timeout of the traffic class of the calling context, within the
+    deadline of the request, and recording it in the metrics and the
+    profile of the request, if any.
+    """
+
+    scheduler = None
+    # request timeout per traffic class, for calls that don't set one
+    timeouts = dict()
+
+    async def perform_request(self, method, url, headers=None, params=None,
+                              body=None):
+        profile = current_profile.get()
+        if profile is not None and profile.es_profile and \
+                url.endswith('/_search') and isinstance(body, dict):
+            body = dict(body, profile=True)
+
+        # the call gets the timeout of its traffic class, cut short by the
+        # deadline of the request; closing a point in time never is, nor
+        # are the later pages of a response that is already being sent
+        name = traffic_class.get()
+        params = dict(params or {})
+        timeout = params.get('request_timeout', self.timeouts.get(name))
+        current = admission.get()
+        streaming = current is not None and current.started
+        closing_pit = method == 'DELETE'
+        left = time_left() if not closing_pit and not streaming else None
+        if left is not None:
+            timeout = left if timeout is None else min(float(timeout), left)
+        if timeout is not None:
+            params['request_timeout'] = timeout
+
+        # closing a point in time runs in the cleanup of a walk, often after
+        # an error; it is cheap and never turned away, or the PIT would leak
+        scheduled = self.scheduler is not None and not closing_pit
+        if scheduled:
+            with profile_phase('es_queue'):
+                await self.scheduler.acquire(name, left)
+        index, operation = es_operation(method, url)
+        started = time.perf_counter()
+        try:
+            with profile_phase('es'):
+                response = await super().perform_request(method, url,
+                                                         headers, params,
+                                                         body)
+        except Exception as e:
+            es_request_errors.inc(index, operation, type(e).__name__)
+            if isinstance(e, ConnectionTimeout) and left is not None:
+                # raises DeadlineExceeded when it was the deadline that hit
+                time_left()
+            raise
+        finally:
+            es_request_duration.observe(time.perf_counter() - started,
+                                        index, operation)
+            if scheduled:
+                self.scheduler.release(name)
+
+        if isinstance(response, dict) and 'took' in response:
+            es_took.observe(response['took'] / 1000, index, operation)
+        if profile is not None:
+            profile.record_es(response)
+        return response
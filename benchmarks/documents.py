@@ -0,0 +1,164 @@
+import random
+
+from app.constants import PHYLOGENETIC_RANKS
+
+# most distinct taxa per rank, fewer when there are few species
+TAXA_PER_RANK = {'kingdom': 3, 'phylum': 12, 'class': 40, 'order': 150,
+                 'family': 500, 'genus': 2000}
+RANK_SUFFIXES = {'kingdom': '', 'phylum': 'phyta', 'class': 'opsida',
+                 'order': 'ales', 'family': 'idae', 'genus': ''}
+STATUSES = ('Done', 'Waiting')
+PROJECTS = ('ERGA', 'ERGA-BGE', 'ERGA-Pilot', 'DToL', 'ASG')
+CURRENT_STATUSES = ('Biosamples - Done', 'Raw Data - Done',
+                    'Mapped Reads - Done', 'Assemblies - Done',
+                    'Annotation Complete - Done', 'Annotation - Done')
+SEXES = ('male', 'female', 'hermaphrodite', 'not collected', 'not applicable')
+ORGANISM_PARTS = ('WHOLE_ORGANISM', 'MUSCLE', 'LEAF', 'HEAD', 'THORAX',
+                  'ABDOMEN', 'GONAD', 'BLOOD', 'MYCELIUM', 'SEED')
+TRACKING_SYSTEMS = ('Submitted to BioSamples', 'Raw Data - Submitted',
+                    'Assemblies - Submitted', 'Waiting')
+PROTOCOLS = ('PacBio - HiFi', 'Hi-C - Arima v2', 'Hi-C - Omni-C',
+             'RNA PolyA', 'ONT - Ultralong', '10X', 'Illumina PE',
+             'Chromium genome')
+PLATFORMS = ('PACBIO_SMRT', 'ILLUMINA', 'OXFORD_NANOPORE')
+JOURNALS = ('Wellcome Open Research', 'Genome Biology and Evolution',
+            'G3 Genes|Genomes|Genetics', 'GigaScience', 'Scientific Data',
+            'Molecular Ecology Resources', 'Nature', 'PLOS Biology')
+ARTICLE_TYPES = ('Data Note', 'Research Article', 'Review', 'Preprint')
+SYLLABLES = ('ae', 'an', 'ar', 'bo', 'ca', 'da', 'el', 'fi', 'go', 'hy',
+             'is', 'lo', 'ma', 'ne', 'or', 'pa', 'ri', 'sa', 'th', 'ur', 'vi')
+
+
+def latin_name(rng, syllables=3):
+    return "".join(rng.choice(SYLLABLES)
+                   for _ in range(syllables)).capitalize()
+
+
+def taxon_names(rng, species):
+    # a fixed tree: every genus, family, ... has one parent, so lineages
+    # agree with each other the way real ones do
+    ranks = PHYLOGENETIC_RANKS[:-1]
+    names = {rank: [latin_name(rng, 2 + depth // 2) + RANK_SUFFIXES[rank]
+                    for _ in range(min(TAXA_PER_RANK[rank],
+                                       max(1, species // 5)))]
+             for depth, rank in enumerate(ranks)}
+    parents = {rank: [rng.randrange(len(names[parent_rank]))
+                      for _ in names[rank]]
+               for parent_rank, rank in zip(ranks, ranks[1:])}
+    return names, parents
+
+
+def lineage(names, parents, genus):
+    ranks = PHYLOGENETIC_RANKS[:-1]
+    positions = {'genus': genus}
+    for parent_rank, rank in reversed(list(zip(ranks, ranks[1:]))):
+        positions[parent_rank] = parents[rank][positions[rank]]
+    return {rank: names[rank][positions[rank]] for rank in ranks}
+
+
+def sample_records(rng, organism, tax_id, count):
+    return [{"accession": f"SAMEA{rng.randrange(10 ** 7, 10 ** 8)}",
+             "organism": organism, "taxonId": tax_id,
+             "sex": rng.choice(SEXES),
+             "organismPart": rng.choice(ORGANISM_PARTS),
+             "trackingSystem": rng.choice(TRACKING_SYSTEMS),
+             "commonName": organism.split()[0].lower(),
+             "lifestage": rng.choice(('adult', 'juvenile', 'larva')),
+             "collectionDate": f"20{rng.randrange(19, 25)}-0{rng.randrange(1, 10)}-1{rng.randrange(10)}",
+             "GAL": "ERGA Biodiversity Genomics Europe",
+             "collectedBy": latin_name(rng, 2) + " " + latin_name(rng, 3)}
+            for _ in range(count)]
+
+
+def experiments(rng, count):
+    return [{"study_accession": f"PRJEB{rng.randrange(10 ** 4, 10 ** 5)}",
+             "run_accession": f"ERR{rng.randrange(10 ** 7, 10 ** 8)}",
+             "library_construction_protocol": rng.choice(PROTOCOLS),
+             "instrument_platform": rng.choice(PLATFORMS),
+             "read_count": str(rng.randrange(10 ** 6, 10 ** 9)),
+             "base_count": str(rng.randrange(10 ** 9, 10 ** 12)),
+             "fastq_ftp": f"ftp.sra.ebi.ac.uk/vol1/fastq/ERR{rng.randrange(10 ** 6)}.fastq.gz"}
+            for _ in range(count)]
+
+
+def status_fields(rng, progress):
+    # later stages are only done once the earlier ones are
+    stages = ('biosamples', 'raw_data', 'mapped_reads', 'assemblies_status',
+              'annotation_complete', 'annotation_status')
+    fields = {stage: STATUSES[position >= progress]
+              for position, stage in enumerate(stages)}
+    fields['currentStatus'] = CURRENT_STATUSES[max(progress - 1, 0)]
+    for prefix in ('symbionts', 'metagenomes'):
+        fields[f'{prefix}_biosamples_status'] = rng.choice(STATUSES)
+        fields[f'{prefix}_raw_data_status'] = rng.choice(STATUSES)
+        fields[f'{prefix}_assemblies_status'] = rng.choice(STATUSES)
+    return fields
+
+
+def generate(species=2000, articles=None, seed=0, max_records=20,
+             max_experiments=10):
+    """Documents of the data_portal, tracking_status, articles and summary
+    indexes as {index: [{"_id", "_source"}, ...]}, the same for the same
+    arguments. `species` data portal documents carry 1 to `max_records`
+    sample records and 0 to `max_experiments` experiments each.
+    """
+    rng = random.Random(seed)
+    names, parents = taxon_names(rng, species)
+    data_portal, tracking_status = [], []
+    for position in range(species):
+        tax_id = str(100000 + position)
+        genus = rng.randrange(len(names['genus']))
+        taxa = lineage(names, parents, genus)
+        organism = f"{taxa['genus']} {latin_name(rng).lower()}"
+        taxa['species'] = organism
+        taxonomies = {rank: [{"scientificName": name,
+                              "commonName": name.lower(),
+                              "tax_id": str(rng.randrange(10 ** 6))}]
+                      for rank, name in taxa.items()}
+        progress = rng.randrange(1, 7)
+        common_name = f"{latin_name(rng, 2).lower()} {rng.choice(('fly', 'moss', 'beetle', 'fern', 'snail', 'moth', 'fish', 'bird'))}"
+        source = {
+            "id": tax_id, "tax_id": tax_id, "organism": organism,
+            "commonName": common_name, "commonNameSource": "NCBI_taxon",
+            "project_name": rng.choice(PROJECTS),
+            "images_available": rng.choice(('true', 'false')),
+            **status_fields(rng, progress),
+            "taxonomies": taxonomies,
+            "records": sample_records(rng, organism, tax_id,
+                                      rng.randint(1, max_records)),
+            "symbionts_records": sample_records(rng, f"{organism} symbiont",
+                                                tax_id, rng.randint(0, 3)),
+            "metagenomes_records": sample_records(rng, f"{organism} metagenome",
+                                                  tax_id, rng.randint(0, 2)),
+            "experiment": experiments(rng, rng.randint(0, max_experiments)),
+            "genome_notes": [{"url": f"https://doi.org/10.12688/wellcomeopenres.{rng.randrange(10 ** 5)}.1",
+                              "title": f"The genome sequence of {organism}"}]
+            if progress >= 5 and rng.random() < 0.5 else [],
+        }
+        data_portal.append({"_id": tax_id, "_source": source})
+        tracking_status.append({"_id": tax_id, "_source": {
+            key: source[key] for key in (
+                "tax_id", "organism", "commonName", "project_name",
+                "taxonomies", "genome_notes", "biosamples", "raw_data",
+                "mapped_reads", "assemblies_status", "annotation_complete",
+                "annotation_status", "currentStatus")}})
+
+    article_documents = []
+    for position in range(species // 4 if articles is None else articles):
+        organism = rng.choice(data_portal)['_source']['organism']
+        journal = rng.choice(JOURNALS)
+        article_documents.append({"_id": f"PMC{1000000 + position}", "_source": {
+            "title": f"The genome sequence of {organism}",
+            "journal_name": journal, "journalTitle": journal,
+            "study_id": f"PRJEB{rng.randrange(10 ** 4, 10 ** 5)}",
+            "organism_name": organism,
+            "pubYear": str(rng.randrange(2019, 2026)),
+            "articleType": rng.choice(ARTICLE_TYPES)}})
+
+    summary = [{"_id": "summary", "_source": {
+        "biosamples": sum(len(doc['_source']['records']) for doc in data_portal),
+        "species": species, "articles": len(article_documents),
+        "assemblies": sum(doc['_source']['assemblies_status'] == 'Done'
+                          for doc in data_portal)}}]
+    return {"data_portal": data_portal, "tracking_status": tracking_status,
+            "articles": article_documents, "summary": summary}
@@ -0,0 +1,117 @@
+import asyncio
+import resource
+import time
+from urllib.parse import urlencode
+
+import orjson
+
+
+class Response:
+    __slots__ = ('status', 'headers', 'size', 'body', 'ttfb', 'elapsed')
+
+    def __init__(self):
+        self.status = None
+        self.headers = []
+        self.size = 0
+        self.body = []
+        self.ttfb = None
+        self.elapsed = None
+
+    def json(self):
+        return orjson.loads(b"".join(self.body))
+
+
+async def call(app, method, path, query=None, json=None, headers=(),
+               keep_body=False):
+    """Sends one request straight to the ASGI `app`, without a server or
+    sockets in between, and times it up to the first and the last byte of
+    the response body.
+    """
+    body = orjson.dumps(json) if json is not None else b""
+    request_headers = [(b"host", b"benchmark"), *headers]
+    if json is not None:
+        request_headers.append((b"content-type", b"application/json"))
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+             "method": method, "scheme": "http", "path": path,
+             "raw_path": path.encode(), "root_path": "",
+             "query_string": urlencode(query or {}).encode(),
+             "headers": request_headers, "client": ("127.0.0.1", 50000),
+             "server": ("benchmark", 80)}
+    response = Response()
+    finished = asyncio.Event()
+    sent = False
+    started = time.perf_counter()
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # the client stays connected until the whole response has arrived
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response.status = message["status"]
+            response.headers = message.get("headers", [])
+        elif message["type"] == "http.response.body":
+            chunk = message.get("body", b"")
+            if chunk and response.ttfb is None:
+                response.ttfb = time.perf_counter() - started
+            response.size += len(chunk)
+            if keep_body:
+                response.body.append(chunk)
+            if not message.get("more_body"):
+                response.elapsed = time.perf_counter() - started
+                finished.set()
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        finished.set()
+    if response.elapsed is None:
+        response.elapsed = time.perf_counter() - started
+    if response.ttfb is None:
+        response.ttfb = response.elapsed
+    return response
+
+
+def percentile(values, fraction):
+    # nearest rank
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, round(fraction * (len(values) - 1)))]
+
+
+def rss_mb():
+    # resident set size of the process right now
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return None
+
+
+def reset_peak_rss():
+    # Linux only: restart the high-water mark reported as VmHWM
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # without /proc only the peak of the whole run is known
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
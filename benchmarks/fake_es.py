@@ -0,0 +1,414 @@
+import asyncio
+import bisect
+import fnmatch
+import functools
+import re
+import time
+import uuid
+from collections import Counter
+from urllib.parse import unquote
+
+import orjson
+from elasticsearch._async.http_aiohttp import AsyncConnection
+from elasticsearch.exceptions import ConnectionTimeout
+
+from app.search_index import source_values
+
+
+class FakeIndex:
+    """Documents of one index with the columns and inverted lists of the
+    fields queries have touched, built the first time a field is used.
+    """
+
+    def __init__(self, name, documents):
+        self.name = name
+        self.documents = documents
+        self.positions = {document['_id']: position
+                          for position, document in enumerate(documents)}
+        self.writes = 0
+        self._columns = dict()
+        self._inverted = dict()
+
+    def column(self, path):
+        values = self._columns.get(path)
+        if values is None:
+            if path == '_id':
+                values = [(document['_id'],) for document in self.documents]
+            else:
+                values = [tuple(source_values(document['_source'], path))
+                          for document in self.documents]
+            self._columns[path] = values
+        return values
+
+    def inverted(self, path):
+        postings = self._inverted.get(path)
+        if postings is None:
+            postings = dict()
+            for position, values in enumerate(self.column(path)):
+                for value in values:
+                    postings.setdefault(value, set()).add(position)
+            self._inverted[path] = postings
+        return postings
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def evaluate(index, query):
+    # positions of the documents matching `query`; nested queries are
+    # evaluated against the whole document, which is close enough for the
+    # queries the service sends
+    everything = set(range(len(index.documents)))
+    if not query:
+        return everything
+    (kind, spec), = query.items()
+    if kind == 'match_all':
+        return everything
+    if kind == 'bool':
+        matched = everything
+        for clause in as_list(spec.get('filter')) + as_list(spec.get('must')):
+            matched = matched & evaluate(index, clause)
+        for clause in as_list(spec.get('must_not')):
+            matched = matched - evaluate(index, clause)
+        should = as_list(spec.get('should'))
+        if should:
+            required = spec.get('minimum_should_match',
+                                0 if 'filter' in spec or 'must' in spec else 1)
+            if required:
+                counts = Counter(position for clause in should
+                                 for position in evaluate(index, clause))
+                matched = {position for position in matched
+                           if counts[position] >= int(required)}
+        return matched
+    if kind == 'nested':
+        return evaluate(index, spec['query'])
+    if kind in ('term', 'terms'):
+        (field, value), = spec.items()
+        if isinstance(value, dict):
+            value = value.get('value')
+        postings = index.inverted(field)
+        matched = set()
+        for term in as_list(value):
+            matched |= postings.get(term, set())
+        return matched
+    if kind == 'ids':
+        return {index.positions[_id] for _id in spec['values']
+                if _id in index.positions}
+    if kind == 'exists':
+        return {position for position, values
+                in enumerate(index.column(spec['field'])) if values}
+    if kind == 'wildcard':
+        (field, value), = spec.items()
+        pattern = re.compile(fnmatch.translate(value['value']),
+                             re.IGNORECASE if value.get('case_insensitive')
+                             else 0)
+        return {position for position, values in enumerate(index.column(field))
+                if any(pattern.match(str(term)) for term in values)}
+    if kind == 'query_string':
+        field, _, value = spec['query'].partition(':')
+        return set(index.inverted(field).get(value, set()))
+    raise ValueError(f"Unsupported query {kind}")
+
+
+def aggregate(index, matched, aggregations):
+    results = dict()
+    for name, spec in aggregations.items():
+        sub_aggregations = spec.get('aggs', {})
+        if 'terms' in spec:
+            counts = Counter()
+            column = index.column(spec['terms']['field'])
+            for position in matched:
+                counts.update(set(column[position]))
+            buckets = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))
+            buckets = buckets[:spec['terms'].get('size', 10)]
+            results[name] = {
+                "doc_count_error_upper_bound": 0,
+                "sum_other_doc_count": sum(counts.values()) - sum(
+                    count for _, count in buckets),
+                "buckets": [dict(key=key, doc_count=count, **aggregate(
+                    index, index.inverted(spec['terms']['field'])[key] & matched,
+                    sub_aggregations)) for key, count in buckets]}
+        elif 'nested' in spec or 'reverse_nested' in spec:
+            results[name] = dict(doc_count=len(matched),
+                                 **aggregate(index, matched, sub_aggregations))
+        elif 'cardinality' in spec:
+            column = index.column(spec['cardinality']['field'])
+            results[name] = {"value": len({value for position in matched
+                                           for value in column[position]})}
+        else:
+            raise ValueError(f"Unsupported aggregation {name}")
+    return results
+
+
+@functools.lru_cache(maxsize=4096)
+def kept(key, includes, excludes):
+    # whether _source filtering keeps the top level field `key`
+    if includes and not any(key == pattern or pattern.startswith(f"{key}.")
+                            or fnmatch.fnmatchcase(key, pattern)
+                            for pattern in includes):
+        return False
+    return not any(key == pattern or fnmatch.fnmatchcase(key, pattern)
+                   for pattern in excludes)
+
+
+def project(source, spec):
+    if spec is None or spec is True:
+        return source
+    if spec is False:
+        return {}
+    if isinstance(spec, (str, list)):
+        spec = {"includes": as_list(spec)}
+    includes = tuple(spec.get('includes') or ())
+    excludes = tuple(spec.get('excludes') or ())
+    return {key: value for key, value in source.items()
+            if kept(key, includes, excludes)}
+
+
+def is_after(values, search_after, orders):
+    for value, after, order in zip(values, search_after, orders):
+        if value == after:
+            continue
+        try:
+            greater = value > after
+        except TypeError:
+            greater = str(value) > str(after)
+        return greater if order == 'asc' else not greater
+    return False
+
+
+class FakeCluster:
+    """In-process stand-in for the Elasticsearch APIs the service uses:
+    search (with point in time, search_after, slices, aggregations and
+    _source filtering), msearch, count, index stats and point-in-time
+    open/close. Every request waits `latency` seconds and is counted by
+    operation in `calls`; `busy` adds up the time spent answering them,
+    which is CPU time of the benchmark process as well.
+
+    A point in time sees the index as it was, so the ordered hits of a
+    query in one are worked out once and reused by its later pages, as
+    deep search_after pages cost ES no more than the first.
+    """
+
+    def __init__(self, indexes, latency=0.0):
+        self.indexes = {name: FakeIndex(name, documents)
+                        for name, documents in indexes.items()}
+        self.latency = latency
+        self.calls = Counter()
+        self.busy = 0.0
+        self.pits = dict()
+        # pit id: {(query, slice, sort): (matched, ordered positions)}
+        self._pit_hits = dict()
+
+    def resolve(self, names):
+        indexes = [self.indexes[name] for name in names.split(",")
+                   if name in self.indexes]
+        if not indexes:
+            raise LookupError(names)
+        return indexes[0]
+
+    def search(self, index, body, params):
+        started = time.perf_counter()
+        body = dict(body or {})
+        pit = body.get('pit')
+        if pit:
+            if pit['id'] not in self.pits:
+                return 404, {"error": {"type": "search_context_missing_exception"},
+                             "status": 404}
+            index = self.pits[pit['id']]
+        for param in ('from', 'size', 'track_total_hits'):
+            if param in params:
+                body.setdefault(param, params[param])
+        if 'sort' in params:
+            body.setdefault('sort', [
+                {field: order or 'asc'} for field, _, order in
+                (item.partition(":") for item in params['sort'].split(","))])
+        if '_source_includes' in params or '_source_excludes' in params:
+            body['_source'] = {
+                "includes": params.get('_source_includes', '').split(",")
+                if params.get('_source_includes') else [],
+                "excludes": params.get('_source_excludes', '').split(",")
+                if params.get('_source_excludes') else []}
+
+        sort = [next(iter(item.items())) if isinstance(item, dict)
+                else (item, 'asc') for item in as_list(body.get('sort'))]
+        sort = [(field, order.get('order', 'asc') if isinstance(order, dict)
+                 else order) for field, order in sort]
+        pit_hits = self._pit_hits.setdefault(pit['id'], dict()) if pit \
+            else dict()
+        key = orjson.dumps([body.get('query'), body.get('slice'), sort])
+        matched, positions = pit_hits.get(key, (None, None))
+        if matched is None:
+            matched, positions = self.ordered(index, body, sort)
+            pit_hits[key] = matched, positions
+
+        def sort_values(position):
+            values = []
+            for field, _ in sort:
+                if field == '_shard_doc':
+                    values.append(position)
+                else:
+                    column = index.column(field)[position]
+                    values.append(column[0] if column else None)
+            return values
+
+        if 'search_after' in body and sort == [('_shard_doc', 'asc')]:
+            # positions are in ascending order already
+            positions = positions[bisect.bisect_right(
+                positions, body['search_after'][0]):]
+        elif 'search_after' in body:
+            orders = [order for _, order in sort]
+            positions = [position for position in positions
+                         if is_after(sort_values(position),
+                                     body['search_after'], orders)]
+
+        start = int(body.get('from', 0))
+        size = int(body.get('size', 10))
+        hits = []
+        for position in positions[start:start + size]:
+            document = index.documents[position]
+            hit = {"_index": index.name, "_type": "_doc",
+                   "_id": document['_id'], "_score": None,
+                   "_source": project(document['_source'], body.get('_source'))}
+            if sort:
+                hit["sort"] = sort_values(position)
+            hits.append(hit)
+        response = {"timed_out": False,
+                    "_shards": {"total": 1, "successful": 1, "skipped": 0,
+                                "failed": 0},
+                    "hits": {"total": {"value": len(matched), "relation": "eq"},
+                             "max_score": None, "hits": hits}}
+        if pit:
+            response["pit_id"] = pit['id']
+        if body.get('aggs') or body.get('aggregations'):
+            response["aggregations"] = aggregate(
+                index, matched, body.get('aggs') or body['aggregations'])
+        response["took"] = int((time.perf_counter() - started) * 1000)
+        return 200, response
+
+    def ordered(self, index, body, sort):
+        # positions of the documents matching `body`, in `sort` order
+        matched = evaluate(index, body.get('query'))
+        if 'slice' in body:
+            slice_id, slices = body['slice']['id'], body['slice']['max']
+            matched = {position for position in matched
+                       if position % slices == slice_id}
+        positions = sorted(matched)
+        for field, order in reversed(sort):
+            if field == '_shard_doc':
+                positions.sort(reverse=order == 'desc')
+                continue
+            column = index.column(field)
+            # missing values go last either way
+            present = [p for p in positions if column[p]]
+            missing = [p for p in positions if not column[p]]
+            present.sort(key=lambda p: str(column[p][0]),
+                         reverse=order == 'desc')
+            positions = present + missing
+        return matched, positions
+
+    def stats(self, names):
+        totals = {"docs": {"count": 0, "deleted": 0},
+                  "indexing": {"index_total": 0, "delete_total": 0}}
+        for name in names.split(","):
+            index = self.indexes.get(name)
+            if index is not None:
+                totals["docs"]["count"] += len(index.documents)
+                totals["indexing"]["index_total"] += index.writes
+        return 200, {"_all": {"primaries": totals}}
+
+    async def handle(self, method, path, params, body):
+        segments = [unquote(segment) for segment in path.strip("/").split("/")
+                    if segment]
+        operation = next((segment for segment in segments
+                          if segment.startswith("_")), "_info")
+        names = segments[0] if segments and not segments[0].startswith("_") \
+            else None
+        self.calls[operation.lstrip("_")] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        started = time.perf_counter()
+        try:
+            return self.dispatch(method, path, operation, names, params, body)
+        finally:
+            self.busy += time.perf_counter() - started
+
+    def dispatch(self, method, path, operation, names, params, body):
+        try:
+            if operation == '_info':
+                return 200, {"name": "benchmark", "version": {
+                    "number": "7.17.0", "build_flavor": "default"},
+                    "tagline": "You Know, for Search"}
+            if operation == '_search':
+                index = self.resolve(names) if names else None
+                return self.search(index, body, params)
+            if operation == '_msearch':
+                responses = []
+                for header, search_body in zip(body[::2], body[1::2]):
+                    try:
+                        status, response = self.search(
+                            self.resolve(header.get('index') or names),
+                            search_body, {})
+                    except (LookupError, ValueError) as e:
+                        status, response = 400, {"error": {
+                            "type": type(e).__name__, "reason": str(e)}}
+                    responses.append(dict(response, status=status))
+                return 200, {"took": 1, "responses": responses}
+            if operation == '_count':
+                index = self.resolve(names)
+                return 200, {"count": len(evaluate(index, (body or {}).get('query')))}
+            if operation == '_pit' and method == 'POST':
+                pit_id = uuid.uuid4().hex
+                self.pits[pit_id] = self.resolve(names)
+                return 200, {"id": pit_id}
+            if operation == '_pit' and method == 'DELETE':
+                found = self.pits.pop(body['id'], None) is not None
+                self._pit_hits.pop(body['id'], None)
+                return (200 if found else 404), {"succeeded": found,
+                                                 "num_freed": int(found)}
+            if operation == '_stats':
+                return self.stats(names)
+        except LookupError as e:
+            return 404, {"error": {"type": "index_not_found_exception",
+                                   "reason": f"no such index [{e}]"},
+                         "status": 404}
+        return 400, {"error": {"type": "unsupported_operation",
+                               "reason": f"{method} {path}"}, "status": 400}
+
+
+class FakeConnection(AsyncConnection):
+    """Connection answering from `cluster` instead of the network; bind a
+    cluster with `FakeConnection.bound_to(cluster)`.
+    """
+
+    cluster = None
+
+    @classmethod
+    def bound_to(cls, cluster):
+        return type('BoundFakeConnection', (cls,), {'cluster': cluster})
+
+    async def perform_request(self, method, url, params=None, body=None,
+                              timeout=None, ignore=(), headers=None):
+        params = {key: value.decode('utf-8') if isinstance(value, bytes)
+                  else str(value) for key, value in (params or {}).items()}
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        if body and url.endswith('/_msearch'):
+            body = [orjson.loads(line) for line in body.splitlines() if line]
+        elif body:
+            body = orjson.loads(body)
+
+        if timeout and self.cluster.latency > timeout:
+            await asyncio.sleep(timeout)
+            raise ConnectionTimeout('TIMEOUT', f"{method} {url} timed out",
+                                    asyncio.TimeoutError())
+        status, response = await self.cluster.handle(method, url, params, body)
+        raw = '' if method == 'HEAD' else orjson.dumps(response).decode('utf-8')
+        if status >= 300 and status not in ignore:
+            self._raise_error(status, raw)
+        return status, {"x-elastic-product": "Elasticsearch"}, raw
+
+    async def close(self):
+        pass
@@ -0,0 +1,538 @@
+"""Benchmarks of the API against an in-process Elasticsearch stand-in.
+
+    python -m benchmarks.run [--species 2000] [--latency 2] [--requests 200]
+                             [--concurrency 8] [--scenarios listing,details]
+                             [--slices 1,2,4,8]
+                             [--export-sizes 10000,100000,1000000]
+                             [--serialization-hits 10000]
+                             [--taxonomy-species 100000]
+
+Runs offline: documents are generated from a seed, the ES client talks to
+benchmarks.fake_es instead of the network and requests go straight to the
+ASGI app. Every scenario reports throughput, p50/p99 latency, time to the
+first byte, peak memory and the ES calls it made per request.
+
+--export-sizes adds one /data-download of each size to the scenarios,
+--serialization-hits compares jsonable_encoder with orjson on a listing of
+that many hits and --taxonomy-species times the taxonomy tree build;
+`--scenarios none` runs only those.
+"""
+import argparse
+import asyncio
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from typing import Callable, NamedTuple
+
+import orjson
+
+from .documents import generate
+from .driver import call, percentile, rss_mb, reset_peak_rss, peak_rss_mb
+from .fake_es import FakeCluster, FakeConnection
+
+ES_HOST = 'http://es.benchmark:9200'
+
+
+class Scenario(NamedTuple):
+    name: str
+    # request(i, previous response) -> (method, path, query, json body)
+    request: Callable
+    # share of --requests this scenario sends
+    scale: float = 1.0
+    concurrency: int | None = None
+    # caches are cleared before every request instead of once at the start
+    cold: bool = False
+    # requests are sent one after the other, each seeing the previous response
+    chained: bool = False
+    # request(i) sent in a loop by `background_concurrency` clients while the
+    # scenario runs, not measured
+    background: Callable | None = None
+    background_concurrency: int = 0
+
+
+def download_query(index='data_portal', export_format='csv', slices=None,
+                   option='metadata', sort=''):
+    return {"pageIndex": 0, "pageSize": 15, "searchValue": "",
+            "sortValue": sort, "filterValue": "", "currentClass": "kingdom",
+            "phylogeny_filters": "", "index_name": index,
+            "downloadOption": option, "slices": slices,
+            "format": export_format}
+
+
+def scenarios(documents, seed, slices=(1, 2, 4, 8)):
+    rng = random.Random(seed)
+    sources = [document['_source'] for document in documents['data_portal']]
+    ids = [document['_id'] for document in documents['data_portal']]
+    rng.shuffle(ids)
+    organisms = [source['organism'] for source in sources]
+    kingdoms = sorted({source['taxonomies']['kingdom'][0]['scientificName']
+                       for source in sources})
+    orders = sorted({source['taxonomies']['order'][0]['scientificName']
+                     for source in sources})
+    filters = [None, 'biosamples:Done', 'raw_data:Waiting',
+               'project_name:ERGA', 'assemblies_status:Done',
+               'experimentType:PacBio - HiFi', 'genome_notes:true',
+               f'kingdom:{kingdoms[0]}']
+    sorts = [None, 'organism:asc', 'commonName:desc']
+    # substrings of real names resolve in the search index, single letters
+    # fall back to wildcards in ES
+    searches = [organism.split()[1][1:5] for organism in organisms[:20]] + \
+        ['a', 'e']
+
+    def listing(i, previous):
+        return 'GET', '/data_portal', {
+            key: value for key, value in (
+                ('filter', filters[i % len(filters)]),
+                ('sort', sorts[i % len(sorts)]),
+                ('offset', 15 * (i % 5)),
+                ('phylogeny_filters', f'order:{orders[i % len(orders)]}'
+                 if i % 4 == 3 else None)) if value is not None}, None
+
+    def listing_search(i, previous):
+        return 'GET', '/data_portal', {'search': searches[i % len(searches)]}, \
+            None
+
+    def details(i, previous):
+        return 'GET', f'/data_portal/{ids[i % len(ids)]}', None, None
+
+    def page_batch(i, previous):
+        page = {"listing": {"type": "listing", "index": "data_portal",
+                            "filter": filters[i % len(filters)]},
+                "summary": {"type": "summary"}}
+        for position in range(3):
+            page[f"record{position}"] = {
+                "type": "details", "index": "data_portal",
+                "record_id": ids[(3 * i + position) % len(ids)]}
+        return 'POST', '/batch', None, {"requests": page}
+
+    pages = max(1, len(ids) // 100)
+
+    def cursor_walk(i, previous):
+        cursor = '*'
+        if previous is not None and i % pages:
+            cursor = previous.json()['next'] or '*'
+        return 'GET', '/data_portal', {'stage': 'hits', 'limit': 100,
+                                       'sort': 'tax_id:asc',
+                                       'cursor': cursor}, None
+
+    def offset_walk(i, previous):
+        return 'GET', '/data_portal', {'stage': 'hits', 'limit': 100,
+                                       'sort': 'tax_id:asc',
+                                       'offset': 100 * (i % pages)}, None
+
+    def download(export_format='csv', slices=None, option='metadata',
+                 sort=''):
+        return lambda i, previous=None: (
+            'POST', '/data-download', None,
+            download_query(export_format=export_format, slices=slices,
+                           option=option, sort=sort))
+
+    def downloader(i, previous):
+        return 'GET', '/downloader_utility_data/', {
+            'taxonomy_filter': kingdoms[i % len(kingdoms)],
+            'data_status': 'Biosamples - Done', 'experiment_type': '',
+            'project_name': ''}, None
+
+    def species(i, previous):
+        start = (200 * i) % len(organisms)
+        return 'GET', '/downloader_utility_data_with_species/', {
+            'species_list': ",".join(organisms[start:start + 200]),
+            'project_name': 'ERGA'}, None
+
+    return [
+        Scenario('listing', listing),
+        Scenario('listing_cold', listing, scale=0.25, cold=True),
+        Scenario('listing_search', listing_search),
+        Scenario('listing_hits_500', lambda i, previous: (
+            'GET', '/data_portal', {'stage': 'hits', 'limit': 500,
+                                    'offset': 500 * (i % 4)}, None),
+                 scale=0.25),
+        Scenario('articles', lambda i, previous: (
+            'GET', '/articles', {'offset': 15 * (i % 10)}, None)),
+        Scenario('details', details, cold=True),
+        Scenario('details_cached', lambda i, previous: details(i % 20, None)),
+        Scenario('details_batch', lambda i, previous: (
+            'POST', '/data_portal/details', None,
+            {"record_ids": [ids[(20 * i + n) % len(ids)] for n in range(20)]}),
+                 scale=0.25),
+        # concurrent copies of one query with cold caches share one search
+        Scenario('listing_identical', lambda i, previous: (
+            'GET', '/data_portal', {'filter': 'biosamples:Done'}, None),
+                 cold=True),
+        Scenario('page_batch', page_batch),
+        Scenario('summary', lambda i, previous: ('GET', '/summary', None, None)),
+        Scenario('autocomplete', lambda i, previous: (
+            'GET', '/autocomplete', {'q': searches[i % len(searches)]}, None)),
+        Scenario('cursor_walk', cursor_walk, scale=0.25, concurrency=1,
+                 chained=True),
+        Scenario('offset_walk', offset_walk, scale=0.25, concurrency=1),
+        Scenario('download_csv', download(), scale=0.05, concurrency=2),
+        *(Scenario(f'download_csv_slices_{count}', download(slices=count),
+                   scale=0.05, concurrency=2) for count in slices),
+        *(Scenario(f'download_csv_sorted_slices_{count}',
+                   download(slices=count, sort='tax_id:asc'), scale=0.05,
+                   concurrency=2) for count in slices),
+        Scenario('download_ndjson', download('ndjson', option='all'),
+                 scale=0.05, concurrency=2),
+        Scenario('download_parquet', download('parquet', option='all'),
+                 scale=0.05, concurrency=2),
+        Scenario('downloader', downloader, scale=0.05, concurrency=2),
+        Scenario('species', species, scale=0.1, concurrency=2),
+        # interactive latency while exports hold the bulk pool
+        Scenario('details_under_export', details, scale=0.25, cold=True,
+                 background=download('ndjson', option='all'),
+                 background_concurrency=4),
+    ]
+
+
+def clear_caches(main):
+    main.facet_cache.invalidate(None)
+    main.details_cache.invalidate(None)
+
+
+async def run_scenario(main, cluster, scenario, count, concurrency,
+                       trace_memory=False):
+    clear_caches(main)
+    calls = Counter(cluster.calls)
+    busy = cluster.busy
+    reset_peak_rss()
+    rss_before = rss_mb()
+    if trace_memory:
+        tracemalloc.reset_peak()
+    responses = []
+    counter = iter(range(count))
+    done = asyncio.Event()
+
+    async def client():
+        previous = None
+        for i in counter:
+            if scenario.cold:
+                clear_caches(main)
+            method, path, query, body = scenario.request(i, previous)
+            response = await call(main.app, method, path, query, body,
+                                  keep_body=scenario.chained)
+            responses.append(response)
+            previous = response
+
+    async def background_client():
+        i = 0
+        while not done.is_set():
+            method, path, query, body = scenario.background(i)
+            await call(main.app, method, path, query, body)
+            i += 1
+
+    background = [asyncio.create_task(background_client())
+                  for _ in range(scenario.background_concurrency)]
+    if background:
+        # let the background load take its slots first
+        await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    clients = 1 if scenario.chained else scenario.concurrency or concurrency
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+
+    latencies = [response.elapsed for response in responses]
+    calls = Counter(cluster.calls) - calls
+    result = {
+        "scenario": scenario.name, "requests": len(responses),
+        "concurrency": clients,
+        "errors": sum(response.status >= 400 for response in responses),
+        "statuses": {str(status): count for status, count in Counter(
+            response.status for response in responses).items()},
+        "throughput": len(responses) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "ttfb_p50_ms": percentile([response.ttfb for response in responses],
+                                  0.5) * 1000,
+        "kb_per_request": sum(response.size for response in responses)
+        / len(responses) / 1024,
+        "es_calls": {operation: count / len(responses)
+                     for operation, count in sorted(calls.items())},
+        "es_busy_ms_per_request": (cluster.busy - busy) * 1000 / len(responses),
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_growth_mb": peak_rss_mb() - rss_before
+        if rss_before is not None else None,
+    }
+    if trace_memory:
+        result["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    return result
+
+
+COLUMNS = (
+    # result key, header, width, format
+    ("scenario", "scenario", 30, ""), ("requests", "requests", 8, "d"),
+    ("errors", "errors", 6, "d"), ("throughput", "req/s", 8, ".1f"),
+    ("p50_ms", "p50 ms", 8, ".1f"), ("p99_ms", "p99 ms", 8, ".1f"),
+    ("ttfb_p50_ms", "ttfb p50", 8, ".1f"),
+    ("kb_per_request", "KB/req", 8, ".1f"),
+    ("es_busy_ms_per_request", "ES ms", 6, ".1f"),
+    ("peak_rss_mb", "peak MB", 7, ".0f"),
+    ("es_calls", "ES calls/request", 0, ""),
+)
+
+
+SERIALIZATION_COLUMNS = (
+    ("encoder", "encoder", 18, ""), ("hits", "hits", 8, "d"),
+    ("ms", "ms", 10, ".1f"), ("mb", "MB", 8, ".1f"),
+    ("identical", "same bytes as orjson", 0, ""),
+)
+
+TAXONOMY_COLUMNS = (
+    ("species", "species", 8, "d"), ("taxa", "taxa", 8, "d"),
+    ("refresh_seconds", "refresh s", 9, ".2f"),
+    ("build_seconds", "build s", 8, ".2f"),
+    ("tree_mb", "tree MB", 8, ".1f"),
+    ("peak_traced_mb", "peak MB", 8, ".1f"),
+)
+
+
+def report(results, columns=COLUMNS, out=sys.stdout):
+    print("  ".join(header.rjust(width) if spec else header.ljust(width)
+                    for _, header, width, spec in columns), file=out)
+    for result in results:
+        cells = []
+        for key, _, width, spec in columns:
+            value = result[key]
+            if key == "es_calls":
+                value = " ".join(f"{operation}={count:.2f}"
+                                 for operation, count in value.items())
+            cells.append(format(value, spec).rjust(width) if spec
+                         else format(value, spec).ljust(width))
+        print("  ".join(cells), file=out)
+
+
+def connect(main, cluster):
+    # the app's client, talking to `cluster` with the transport settings of
+    # the client it replaces
+    from app.transport import ScheduledTransport
+    from elasticsearch import AsyncElasticsearch
+
+    es = AsyncElasticsearch(
+        [ES_HOST], timeout=main.ES_TIMEOUT,
+        connection_class=FakeConnection.bound_to(cluster),
+        transport_class=ScheduledTransport, max_retries=0)
+    es.transport.scheduler = main.es.transport.scheduler
+    es.transport.timeouts = main.es.transport.timeouts
+    main.es = es
+    return es
+
+
+def repeated(documents, size):
+    # `size` documents with ids of their own sharing the _source of the
+    # generated ones, so a million of them fit in memory
+    return [{"_id": str(position),
+             "_source": documents[position % len(documents)]['_source']}
+            for position in range(size)]
+
+
+async def export_sweep(main, documents, sizes, latency, trace_memory):
+    # one /data-download of `size` data_portal documents per size; the RSS
+    # growth and traced peak are those of the export, the documents are in
+    # memory before it starts
+    results = []
+    for size in sizes:
+        cluster = FakeCluster(
+            {'data_portal': repeated(documents['data_portal'], size)},
+            latency=latency)
+        connect(main, cluster)
+        gc.collect()
+        scenario = Scenario(f'export_{size}', lambda i, previous: (
+            'POST', '/data-download', None, download_query()))
+        print(f"Running {scenario.name}...", file=sys.stderr)
+        results.append(await run_scenario(main, cluster, scenario, 1, 1,
+                                          trace_memory))
+        del cluster
+    return results
+
+
+def serialization_benchmark(documents, hits, repeats=3):
+    # a listing of `hits` hits encoded as FastAPI did (jsonable_encoder and
+    # JSONResponse) and as the endpoints do now (ORJSONResponse)
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse, ORJSONResponse
+
+    sources = documents['data_portal']
+    data = {"results": [{"_index": "data_portal", "_type": "_doc",
+                         "_id": str(position), "_score": None,
+                         "_source": sources[position % len(sources)]['_source']}
+                        for position in range(hits)]}
+    encoders = (
+        ("jsonable_encoder", lambda: JSONResponse(jsonable_encoder(data)).body),
+        ("orjson", lambda: ORJSONResponse(data).body))
+    bodies, results = dict(), []
+    for name, encode in encoders:
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            bodies[name] = encode()
+            timings.append(time.perf_counter() - started)
+        results.append({"encoder": name, "hits": hits,
+                        "ms": min(timings) * 1000,
+                        "mb": len(bodies[name]) / 2 ** 20})
+    for result in results:
+        result["identical"] = bodies[result["encoder"]] == bodies["orjson"]
+    return results
+
+
+async def taxonomy_benchmark(species, seed):
+    # the scan and build of the taxonomy index over `species` documents,
+    # and the build of the tree alone with its memory
+    from app.taxonomy import TaxonomyIndex, TaxonomyTree, document_lineage
+
+    print(f"Generating {species} species for the taxonomy...",
+          file=sys.stderr)
+    documents = generate(species, articles=0, seed=seed, max_records=1,
+                         max_experiments=0)['data_portal']
+    cluster = FakeCluster({'data_portal': [
+        {"_id": document['_id'],
+         "_source": {"taxonomies": document['_source']['taxonomies']}}
+        for document in documents]})
+    del documents
+    from elasticsearch import AsyncElasticsearch
+    es = AsyncElasticsearch([ES_HOST], max_retries=0,
+                            connection_class=FakeConnection.bound_to(cluster))
+    index = TaxonomyIndex('data_portal')
+    await index.refresh(es)
+    await es.close()
+
+    lineages = [document_lineage(document['_source'])
+                for document in cluster.indexes['data_portal'].documents]
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    gc.collect()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    tree = TaxonomyTree(lineages)
+    build_seconds = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    if not tracing:
+        tracemalloc.stop()
+    return {"species": species, "taxa": len(tree.nodes),
+            "refresh_seconds": index.build_seconds,
+            "build_seconds": build_seconds,
+            "tree_mb": (current - before) / 2 ** 20,
+            "peak_traced_mb": (peak - before) / 2 ** 20}
+
+
+async def main_async(args):
+    # configuration is read when app.main is imported
+    os.environ.update({
+        'ES_HOST': ES_HOST, 'ES_USERNAME': 'benchmark',
+        'ES_PASSWORD': 'benchmark',
+        'EXPORT_SPOOL_DIR': tempfile.mkdtemp(prefix='benchmark-exports-'),
+    })
+    from app import main
+
+    print(f"Generating {args.species} species...", file=sys.stderr)
+    documents = generate(args.species, args.articles, args.seed)
+    cluster = FakeCluster(documents, latency=args.latency / 1000)
+    es = connect(main, cluster)
+
+    requested = [name for name in args.scenarios or () if name != 'none']
+    selected = [scenario for scenario in scenarios(documents, args.seed,
+                                                   args.slices)
+                if scenario.name in requested or not args.scenarios]
+    unknown = set(requested) - {scenario.name for scenario in selected}
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    if args.trace_memory:
+        tracemalloc.start()
+    results = []
+    await main.app.router.startup()
+    # the periodic refreshes started in the background, they are
+    # awaited here so no scenario runs before the indexes are built
+    await main.search_indexes.refresh(es)
+    await main.taxonomy_index.refresh(es)
+    await main.summary_snapshot.refresh()
+    try:
+        for scenario in selected:
+            count = max(1, round(args.requests * scenario.scale))
+            print(f"Running {scenario.name} ({count} requests)...",
+                  file=sys.stderr)
+            results.append(await run_scenario(
+                main, cluster, scenario, count, args.concurrency,
+                args.trace_memory))
+        if args.export_sizes:
+            results.extend(await export_sweep(
+                main, documents, args.export_sizes, args.latency / 1000,
+                args.trace_memory))
+    finally:
+        await main.app.router.shutdown()
+
+    output = {"arguments": vars(args), "results": results}
+    report(results)
+    if args.serialization_hits:
+        print("Comparing encoders...", file=sys.stderr)
+        output["serialization"] = serialization_benchmark(
+            documents, args.serialization_hits)
+        print()
+        report(output["serialization"], SERIALIZATION_COLUMNS)
+    if args.taxonomy_species:
+        output["taxonomy"] = await taxonomy_benchmark(args.taxonomy_species,
+                                                      args.seed)
+        print()
+        report([output["taxonomy"]], TAXONOMY_COLUMNS)
+    if args.json:
+        with open(args.json, 'wb') as f:
+            f.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
+
+
+def names(value):
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+def numbers(value):
+    return [int(number) for number in names(value)]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run',
+                                     description=__doc__.split("\n")[0])
+    parser.add_argument('--species', type=int, default=2000,
+                        help="data_portal documents to generate")
+    parser.add_argument('--articles', type=int, default=None,
+                        help="articles documents, a quarter of --species "
+                             "by default")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=2.0,
+                        help="milliseconds every ES call takes on top of "
+                             "the work of the stand-in")
+    parser.add_argument('--requests', type=int, default=200,
+                        help="requests per scenario, downloads send fewer")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="clients sending requests at the same time")
+    parser.add_argument('--scenarios', type=names,
+                        help="comma separated scenarios to run, all by "
+                             "default, none for only the measurements below")
+    parser.add_argument('--slices', type=numbers, default=(1, 2, 4, 8),
+                        help="slice counts of the download_csv_slices_* "
+                             "and download_csv_sorted_slices_* scenarios")
+    parser.add_argument('--export-sizes', type=numbers,
+                        help="comma separated document counts to export "
+                             "once each, e.g. 10000,100000,1000000")
+    parser.add_argument('--serialization-hits', type=int, default=0,
+                        help="hits of the listing encoded with "
+                             "jsonable_encoder and with orjson")
+    parser.add_argument('--taxonomy-species', type=int, default=0,
+                        help="species to build the taxonomy tree of")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="also report the peak of Python allocations "
+                             "(slows every scenario down)")
+    parser.add_argument('--json', help="file to write the results to")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    asyncio.run(main_async(parse_args()))
@@ -0,0 +1,37 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+
+from app.export_jobs import ExportJobs, parse_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", (0, 9)),
+    ("bytes=90-", (90, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=-500", (0, 99)),
+    ("bytes=50-500", (50, 99)),
+    ("bytes=100-", None),
+    ("bytes=9-5", None),
+    ("bytes=0-1,5-6", None),
+    ("bytes=a-b", None),
+    ("items=0-9", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+def test_start_removes_files_of_earlier_processes(tmp_path):
+    orphans = [f"{uuid.uuid4().hex}.csv", f"{uuid.uuid4().hex}.csv.gz.part"]
+    for name in orphans + ["notes.txt"]:
+        (tmp_path / name).write_bytes(b"x")
+
+    async def run():
+        jobs = ExportJobs(str(tmp_path), workers=1)
+        jobs.start()
+        await jobs.stop()
+
+    asyncio.run(run())
+    assert os.listdir(tmp_path) == ["notes.txt"]
@@ -0,0 +1,143 @@
+import asyncio
+import statistics
+import time
+
+import pytest
+from elasticsearch import AsyncElasticsearch
+
+from app.pagination import decode_cursor, encode_cursor, iterate_pages, \
+    iterate_sliced_pages, merge_key, parse_sort
+from benchmarks.documents import generate
+from benchmarks.fake_es import FakeCluster, FakeConnection
+
+
+def walk(species, fn):
+    # runs fn(cluster, es) against a stand-in holding `species` documents
+    async def run():
+        cluster = FakeCluster(generate(species, articles=0))
+        es = AsyncElasticsearch(
+            ['http://es.test:9200'], max_retries=0,
+            connection_class=FakeConnection.bound_to(cluster))
+        try:
+            return await fn(cluster, es)
+        finally:
+            await es.close()
+    return asyncio.run(run())
+
+
+async def collect(pages):
+    hits = []
+    async for page in pages:
+        hits.extend(page)
+    return hits
+
+
+def test_parse_sort():
+    assert parse_sort(None) == []
+    assert parse_sort("organism:desc, tax_id,") == [
+        {"organism": "desc"}, {"tax_id": "asc"}]
+
+
+def test_merge_key_orders_missing_values_last():
+    hits = [{"sort": [value, position]} for position, value in
+            enumerate(["b", None, "c", "a"])]
+    ascending = sorted(hits, key=lambda hit: merge_key(hit, ['asc', 'asc']))
+    descending = sorted(hits, key=lambda hit: merge_key(hit, ['desc', 'asc']))
+    assert [hit["sort"][0] for hit in ascending] == ["a", "b", "c", None]
+    assert [hit["sort"][0] for hit in descending] == ["c", "b", "a", None]
+
+
+@pytest.mark.parametrize("sort", ["organism:desc", "commonName:asc"])
+def test_sliced_walk_merges_in_sort_order(sort):
+    field, _, order = sort.partition(":")
+
+    async def run(cluster, es):
+        body = {"query": {"match_all": {}}}
+        single = await collect(iterate_pages(
+            es, 'data_portal', body, sort=sort, page_size=25))
+        sliced = await collect(iterate_sliced_pages(
+            es, 'data_portal', body, sort=sort, page_size=25, slices=3,
+            concurrency=2))
+        return single, sliced, cluster.pits
+
+    single, sliced, pits = walk(300, run)
+    values = [hit["_source"][field] for hit in sliced]
+    assert values == sorted(values, reverse=order == 'desc')
+    assert values == [hit["_source"][field] for hit in single]
+    assert sorted(hit["_id"] for hit in sliced) == \
+        sorted(hit["_id"] for hit in single)
+    assert len(sliced) == 300
+    assert not pits
+
+
+def test_unsorted_sliced_walk_returns_every_hit_once():
+    async def run(cluster, es):
+        return await collect(iterate_sliced_pages(
+            es, 'data_portal', {}, page_size=40, slices=4)), cluster.pits
+
+    hits, pits = walk(250, run)
+    assert len({hit["_id"] for hit in hits}) == len(hits) == 250
+    assert not pits
+
+
+def test_walk_closes_its_pit_when_abandoned():
+    async def run(cluster, es):
+        for slices in (1, 3):
+            pages = iterate_sliced_pages(es, 'data_portal', {},
+                                         sort='tax_id:asc', page_size=10,
+                                         slices=slices)
+            await pages.__anext__()
+            await pages.aclose()
+        return cluster.pits, cluster.calls['pit']
+
+    pits, opened_and_closed = walk(100, run)
+    assert not pits
+    assert opened_and_closed == 4
+
+
+def test_page_latency_stays_flat():
+    # every page costs the same however deep it is: requests don't grow
+    # with the depth and the last pages take no longer than the first
+    page_size = 50
+    sent = []
+
+    async def run(cluster, es):
+        search = cluster.search
+
+        def recorded(index, body, params):
+            sent.append(dict(body))
+            return search(index, body, params)
+
+        cluster.search = recorded
+        timings = []
+        pages = iterate_pages(es, 'data_portal', {}, sort='tax_id:asc',
+                              page_size=page_size)
+        started = time.perf_counter()
+        async for _ in pages:
+            timings.append(time.perf_counter() - started)
+            started = time.perf_counter()
+        return timings
+
+    timings = walk(3000, run)
+    assert len(timings) == 3000 // page_size
+    assert all('from' not in body and body['size'] == page_size
+               for body in sent)
+    quarter = len(timings) // 4
+    first = statistics.median(timings[:quarter])
+    last = statistics.median(timings[-quarter:])
+    assert last < first * 2 + 0.005
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor("pit-1", ["Apis mellifera", 42], "query-a")
+    assert "=" not in cursor
+    assert decode_cursor(cursor, "query-a") == ("pit-1",
+                                                ["Apis mellifera", 42])
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor", encode_cursor("pit-1", [1], "query-b"),
+    encode_cursor("pit-1", "not a list", "query-a")])
+def test_cursor_rejected(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, "query-a")
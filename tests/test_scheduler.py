@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from app.scheduler import Admission, Pool, PoolBusy, Scheduler, admission
+
+
+def scheduler(max_concurrency=1, **bulk):
+    return Scheduler([Pool('interactive', 0, 1),
+                      Pool('bulk', 2, 1, **bulk)], max_concurrency)
+
+
+def test_free_slot_goes_to_the_highest_priority_waiter():
+    async def run():
+        pools = scheduler()
+        await pools.acquire('bulk')
+        admitted = []
+
+        async def wait(name):
+            await pools.acquire(name)
+            admitted.append(name)
+
+        waiters = [asyncio.ensure_future(wait('bulk')),
+                   asyncio.ensure_future(wait('interactive'))]
+        await asyncio.sleep(0)
+        pools.release('bulk')
+        await asyncio.sleep(0.01)
+        pools.release(admitted[0])
+        await asyncio.gather(*waiters)
+        return admitted
+
+    assert asyncio.run(run()) == ['interactive', 'bulk']
+
+
+def test_full_queue_is_turned_away_with_429():
+    async def run():
+        pools = scheduler(max_queue=1)
+        await pools.acquire('bulk')
+        waiter = asyncio.ensure_future(pools.acquire('bulk'))
+        await asyncio.sleep(0)
+        with pytest.raises(PoolBusy) as busy:
+            await pools.acquire('bulk')
+        pools.release('bulk')
+        await waiter
+        return busy.value, pools.pools['bulk']
+
+    busy, pool = asyncio.run(run())
+    assert busy.status_code == 429
+    assert busy.retry_after >= 1
+    assert pool.rejected == 1
+
+
+def test_waiting_past_max_wait_gives_503():
+    async def run():
+        pools = scheduler(max_wait=0.02)
+        await pools.acquire('bulk')
+        with pytest.raises(PoolBusy) as busy:
+            await pools.acquire('bulk')
+        return busy.value, pools.pools['bulk']
+
+    busy, pool = asyncio.run(run())
+    assert busy.status_code == 503
+    assert pool.timed_out == 1
+    assert pool.waiting == 0
+
+
+def test_started_response_waits_past_max_wait():
+    async def run():
+        pools = scheduler(max_wait=0.02)
+        await pools.acquire('bulk')
+        started = Admission()
+        started.started = True
+        admission.set(started)
+        waiter = asyncio.ensure_future(pools.acquire('bulk'))
+        await asyncio.sleep(0.05)
+        pools.release('bulk')
+        await waiter
+        return pools.pools['bulk']
+
+    assert asyncio.run(run()).timed_out == 0
+
+
+def test_waiters_of_a_full_pool_do_not_hold_back_others():
+    async def run():
+        pools = scheduler(max_concurrency=2)
+        await pools.acquire('bulk')
+        waiter = asyncio.ensure_future(pools.acquire('bulk'))
+        await asyncio.sleep(0)
+        # the bulk waiter only waits for its own pool
+        await asyncio.wait_for(pools.acquire('interactive'), 0.1)
+        pools.release('bulk')
+        await waiter
+        return pools.active
+
+    assert asyncio.run(run()) == 2